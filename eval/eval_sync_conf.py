@@ -14,6 +14,7 @@
 
 import argparse
 import os
+import tempfile
 import tqdm
 from statistics import fmean
 from eval.syncnet import SyncNetEval
@@ -22,8 +23,13 @@ from latentsync.utils.util import red_text
 import torch
 
 
-def syncnet_eval(syncnet, syncnet_detector, video_path, temp_dir, detect_results_dir="detect_results"):
-    syncnet_detector(video_path=video_path, min_track=50)
+def syncnet_eval(syncnet, syncnet_detector, video_path, temp_dir=None, detect_results_dir=None):
+    # Unless the directories are given, every call works in scratch directories of its own
+    if detect_results_dir is None:
+        with tempfile.TemporaryDirectory(prefix="detect_results_") as scratch_dir:
+            return syncnet_eval(syncnet, syncnet_detector, video_path, temp_dir, scratch_dir)
+
+    syncnet_detector(video_path=video_path, min_track=50, detect_results_dir=detect_results_dir)
     crop_videos = os.listdir(os.path.join(detect_results_dir, "crop"))
     if crop_videos == []:
         raise Exception(red_text(f"Face not detected in {video_path}"))
@@ -46,7 +52,7 @@ def main():
     parser.add_argument("--initial_model", type=str, default="checkpoints/auxiliary/syncnet_v2.model", help="")
     parser.add_argument("--video_path", type=str, default=None, help="")
     parser.add_argument("--videos_dir", type=str, default="/root/processed")
-    parser.add_argument("--temp_dir", type=str, default="temp", help="")
+    parser.add_argument("--temp_dir", type=str, default=None, help="")
 
     args = parser.parse_args()
 
@@ -2,7 +2,7 @@
 
 import torch
 import numpy
-import time, pdb, argparse, subprocess, os, math, glob
+import time, pdb, argparse, subprocess, os, math, glob, tempfile
 import cv2
 import python_speech_features
 
@@ -44,7 +44,7 @@ class SyncNetEval(torch.nn.Module):
         self.__S__ = S(num_layers_in_fc_layers=num_layers_in_fc_layers).to(device)
         self.device = device
 
-    def evaluate(self, video_path, temp_dir="temp", batch_size=20, vshift=15):
+    def evaluate(self, video_path, temp_dir=None, batch_size=20, vshift=15):
 
         self.__S__.eval()
 
@@ -52,110 +52,120 @@ class SyncNetEval(torch.nn.Module):
         # Convert files
         # ========== ==========
 
-        if os.path.exists(temp_dir):
-            rmtree(temp_dir)
+        # Each call gets a scratch directory of its own unless one is given, removed even when the evaluation fails
+        if temp_dir is None:
+            temp_dir = tempfile.mkdtemp(prefix="syncnet_eval_")
+        else:
+            if os.path.exists(temp_dir):
+                rmtree(temp_dir)
 
-        os.makedirs(temp_dir)
+            os.makedirs(temp_dir)
 
-        # temp_video_path = os.path.join(temp_dir, "temp.mp4")
-        # command = f"ffmpeg -loglevel error -nostdin -y -i {video_path} -vf scale='224:224' {temp_video_path}"
-        # subprocess.call(command, shell=True)
+        try:
+            # temp_video_path = os.path.join(temp_dir, "temp.mp4")
+            # command = f"ffmpeg -loglevel error -nostdin -y -i {video_path} -vf scale='224:224' {temp_video_path}"
+            # subprocess.call(command, shell=True)
 
-        command = f"ffmpeg -loglevel error -nostdin -y -i {video_path} -f image2 {os.path.join(temp_dir, '%06d.jpg')}"
-        subprocess.call(command, shell=True, stdout=None)
+            command = (
+                f"ffmpeg -loglevel error -nostdin -y -i {video_path} -f image2 {os.path.join(temp_dir, '%06d.jpg')}"
+            )
+            subprocess.call(command, shell=True, stdout=None)
 
-        command = f"ffmpeg -loglevel error -nostdin -y -i {video_path} -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 {os.path.join(temp_dir, 'audio.wav')}"
-        subprocess.call(command, shell=True, stdout=None)
+            command = f"ffmpeg -loglevel error -nostdin -y -i {video_path} -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 {os.path.join(temp_dir, 'audio.wav')}"
+            subprocess.call(command, shell=True, stdout=None)
 
-        # ========== ==========
-        # Load video
-        # ========== ==========
+            # ========== ==========
+            # Load video
+            # ========== ==========
 
-        images = []
+            images = []
 
-        flist = glob.glob(os.path.join(temp_dir, "*.jpg"))
-        flist.sort()
+            flist = glob.glob(os.path.join(temp_dir, "*.jpg"))
+            flist.sort()
 
-        for fname in flist:
-            img_input = cv2.imread(fname)
-            img_input = cv2.resize(img_input, (224, 224))  # HARD CODED, CHANGE BEFORE RELEASE
-            images.append(img_input)
+            for fname in flist:
+                img_input = cv2.imread(fname)
+                img_input = cv2.resize(img_input, (224, 224))  # HARD CODED, CHANGE BEFORE RELEASE
+                images.append(img_input)
 
-        im = numpy.stack(images, axis=3)
-        im = numpy.expand_dims(im, axis=0)
-        im = numpy.transpose(im, (0, 3, 4, 1, 2))
+            im = numpy.stack(images, axis=3)
+            im = numpy.expand_dims(im, axis=0)
+            im = numpy.transpose(im, (0, 3, 4, 1, 2))
 
-        imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
+            imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
 
-        # ========== ==========
-        # Load audio
-        # ========== ==========
+            # ========== ==========
+            # Load audio
+            # ========== ==========
 
-        sample_rate, audio = wavfile.read(os.path.join(temp_dir, "audio.wav"))
-        mfcc = zip(*python_speech_features.mfcc(audio, sample_rate))
-        mfcc = numpy.stack([numpy.array(i) for i in mfcc])
+            sample_rate, audio = wavfile.read(os.path.join(temp_dir, "audio.wav"))
+            mfcc = zip(*python_speech_features.mfcc(audio, sample_rate))
+            mfcc = numpy.stack([numpy.array(i) for i in mfcc])
 
-        cc = numpy.expand_dims(numpy.expand_dims(mfcc, axis=0), axis=0)
-        cct = torch.autograd.Variable(torch.from_numpy(cc.astype(float)).float())
+            cc = numpy.expand_dims(numpy.expand_dims(mfcc, axis=0), axis=0)
+            cct = torch.autograd.Variable(torch.from_numpy(cc.astype(float)).float())
 
-        # ========== ==========
-        # Check audio and video input length
-        # ========== ==========
+            # ========== ==========
+            # Check audio and video input length
+            # ========== ==========
 
-        # if (float(len(audio)) / 16000) != (float(len(images)) / 25):
-        #     print(
-        #         "WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."
-        #         % (float(len(audio)) / 16000, float(len(images)) / 25)
-        #     )
+            # if (float(len(audio)) / 16000) != (float(len(images)) / 25):
+            #     print(
+            #         "WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."
+            #         % (float(len(audio)) / 16000, float(len(images)) / 25)
+            #     )
 
-        min_length = min(len(images), math.floor(len(audio) / 640))
+            min_length = min(len(images), math.floor(len(audio) / 640))
 
-        # ========== ==========
-        # Generate video and audio feats
-        # ========== ==========
+            # ========== ==========
+            # Generate video and audio feats
+            # ========== ==========
 
-        lastframe = min_length - 5
-        im_feat = []
-        cc_feat = []
+            lastframe = min_length - 5
+            im_feat = []
+            cc_feat = []
 
-        tS = time.time()
-        for i in range(0, lastframe, batch_size):
+            tS = time.time()
+            for i in range(0, lastframe, batch_size):
 
-            im_batch = [imtv[:, :, vframe : vframe + 5, :, :] for vframe in range(i, min(lastframe, i + batch_size))]
-            im_in = torch.cat(im_batch, 0)
-            im_out = self.__S__.forward_lip(im_in.to(self.device))
-            im_feat.append(im_out.data.cpu())
+                im_batch = [
+                    imtv[:, :, vframe : vframe + 5, :, :] for vframe in range(i, min(lastframe, i + batch_size))
+                ]
+                im_in = torch.cat(im_batch, 0)
+                im_out = self.__S__.forward_lip(im_in.to(self.device))
+                im_feat.append(im_out.data.cpu())
 
-            cc_batch = [
-                cct[:, :, :, vframe * 4 : vframe * 4 + 20] for vframe in range(i, min(lastframe, i + batch_size))
-            ]
-            cc_in = torch.cat(cc_batch, 0)
-            cc_out = self.__S__.forward_aud(cc_in.to(self.device))
-            cc_feat.append(cc_out.data.cpu())
+                cc_batch = [
+                    cct[:, :, :, vframe * 4 : vframe * 4 + 20] for vframe in range(i, min(lastframe, i + batch_size))
+                ]
+                cc_in = torch.cat(cc_batch, 0)
+                cc_out = self.__S__.forward_aud(cc_in.to(self.device))
+                cc_feat.append(cc_out.data.cpu())
 
-        im_feat = torch.cat(im_feat, 0)
-        cc_feat = torch.cat(cc_feat, 0)
+            im_feat = torch.cat(im_feat, 0)
+            cc_feat = torch.cat(cc_feat, 0)
 
-        # ========== ==========
-        # Compute offset
-        # ========== ==========
+            # ========== ==========
+            # Compute offset
+            # ========== ==========
 
-        dists = calc_pdist(im_feat, cc_feat, vshift=vshift)
-        mean_dists = torch.mean(torch.stack(dists, 1), 1)
+            dists = calc_pdist(im_feat, cc_feat, vshift=vshift)
+            mean_dists = torch.mean(torch.stack(dists, 1), 1)
 
-        min_dist, minidx = torch.min(mean_dists, 0)
+            min_dist, minidx = torch.min(mean_dists, 0)
 
-        av_offset = vshift - minidx
-        conf = torch.median(mean_dists) - min_dist
+            av_offset = vshift - minidx
+            conf = torch.median(mean_dists) - min_dist
 
-        fdist = numpy.stack([dist[minidx].numpy() for dist in dists])
-        # fdist   = numpy.pad(fdist, (3,3), 'constant', constant_values=15)
-        fconf = torch.median(mean_dists).numpy() - fdist
-        framewise_conf = signal.medfilt(fconf, kernel_size=9)
+            fdist = numpy.stack([dist[minidx].numpy() for dist in dists])
+            # fdist   = numpy.pad(fdist, (3,3), 'constant', constant_values=15)
+            fconf = torch.median(mean_dists).numpy() - fdist
+            framewise_conf = signal.medfilt(fconf, kernel_size=9)
 
-        # numpy.set_printoptions(formatter={"float": "{: 0.3f}".format})
-        rmtree(temp_dir)
-        return av_offset.item(), min_dist.item(), conf.item()
+            # numpy.set_printoptions(formatter={"float": "{: 0.3f}".format})
+            return av_offset.item(), min_dist.item(), conf.item()
+        finally:
+            rmtree(temp_dir, ignore_errors=True)
 
     def extract_feature(self, opt, videofile):
 
@@ -22,11 +22,13 @@ class SyncNetDetector:
         self.s3f_detector = S3FD(device=device)
         self.detect_results_dir = detect_results_dir
 
-    def __call__(self, video_path: str, min_track=50, scale=False):
-        crop_dir = os.path.join(self.detect_results_dir, "crop")
-        video_dir = os.path.join(self.detect_results_dir, "video")
-        frames_dir = os.path.join(self.detect_results_dir, "frames")
-        temp_dir = os.path.join(self.detect_results_dir, "temp")
+    def __call__(self, video_path: str, min_track=50, scale=False, detect_results_dir=None):
+        # Concurrent calls must be given different `detect_results_dir`, the results are written there
+        detect_results_dir = detect_results_dir if detect_results_dir is not None else self.detect_results_dir
+        crop_dir = os.path.join(detect_results_dir, "crop")
+        video_dir = os.path.join(detect_results_dir, "video")
+        frames_dir = os.path.join(detect_results_dir, "frames")
+        temp_dir = os.path.join(detect_results_dir, "temp")
 
         # ========== DELETE EXISTING DIRECTORIES ==========
         if os.path.exists(crop_dir):
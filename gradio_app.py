@@ -64,6 +64,13 @@ def create_args(
     parser.add_argument("--inference_steps", type=int, default=20)
     parser.add_argument("--guidance_scale", type=float, default=1.0)
     parser.add_argument("--seed", type=int, default=1247)
+    # The options of scripts/inference.py, with their defaults
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--avatar_cache_dir", type=str, default=None)
+    parser.add_argument("--avatar_cache_size_gb", type=float, default=20)
+    parser.add_argument("--audio_embeds_cache_dir", type=str, default=None)
+    parser.add_argument("--audio_embeds_cache_size_gb", type=float, default=5)
+    parser.add_argument("--window_batch_size", type=int, default=1)
 
     return parser.parse_args(
         [
@@ -0,0 +1,171 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import tqdm
+from decord import AudioReader, VideoReader, cpu
+
+from ..utils.audio import get_hop_size
+from ..utils.disk_cache import hash_file
+
+
+def probe_video(video_path: str, audio_sample_rate: int = 16000):
+    """
+    The frame count, fps, the number of audio samples at `audio_sample_rate` and the content hash of a video, None
+    if it is broken
+    """
+    try:
+        vr = VideoReader(video_path, ctx=cpu(0))
+        num_frames, fps = len(vr), vr.get_avg_fps()
+        vr.seek(0)  # avoid memory leak
+        ar = AudioReader(video_path, ctx=cpu(0), sample_rate=audio_sample_rate, mono=True)
+        num_audio_samples = ar.shape[1]
+        # The key of the embedding cache, so that the dataloader workers never read the videos to hash them
+        content_hash = hash_file(video_path)
+    except Exception as e:
+        print(f"{type(e).__name__} - {e} - {video_path}")
+        return None
+    return num_frames, fps, num_audio_samples, content_hash
+
+
+class DatasetIndex:
+    """
+    Per-video metadata of a fileslist: frame count, fps, duration, audio length, mel spectrogram length and content
+    hash, so that the datasets can sample valid (video, start_idx) pairs up front instead of opening videos only to
+    find they are too short or their mel spectrogram is too short, and look up the embedding cache without hashing
+    the videos.
+    """
+
+    def __init__(
+        self,
+        video_paths,
+        num_frames: np.ndarray,
+        fps: np.ndarray,
+        num_audio_samples: np.ndarray,
+        audio_sample_rate: int = 16000,
+        content_hashes=None,
+    ):
+        self.video_paths = list(video_paths)
+        self.num_frames = np.asarray(num_frames, dtype=np.int64)
+        self.fps = np.asarray(fps, dtype=np.float64)
+        self.num_audio_samples = np.asarray(num_audio_samples, dtype=np.int64)
+        self.audio_sample_rate = audio_sample_rate
+        # None for the indexes built before the content hashes were added
+        self.content_hashes = None if content_hashes is None else list(content_hashes)
+        self.durations = self.num_frames / self.fps
+        # The centered frames of `melspectrogram`
+        self.num_mel_frames = self.num_audio_samples // get_hop_size() + 1
+
+    def __len__(self):
+        return len(self.video_paths)
+
+    @classmethod
+    def build(cls, video_paths, num_workers: int = 16, audio_sample_rate: int = 16000):
+        video_paths = list(video_paths)
+        with Pool(num_workers) as pool:
+            results = list(tqdm.tqdm(pool.imap(probe_video, video_paths, chunksize=16), total=len(video_paths)))
+
+        valid = [(video_path, result) for video_path, result in zip(video_paths, results) if result is not None]
+        if len(valid) < len(video_paths):
+            print(f"{len(video_paths) - len(valid)} broken videos are left out of the index")
+        num_frames, fps, num_audio_samples, content_hashes = (
+            zip(*[result for _, result in valid]) if valid else ([], [], [], [])
+        )
+        return cls(
+            [video_path for video_path, _ in valid],
+            num_frames,
+            fps,
+            num_audio_samples,
+            audio_sample_rate,
+            content_hashes,
+        )
+
+    def save(self, index_path: str):
+        temp_path = f"{index_path}.tmp.npz"
+        arrays = dict(
+            video_paths=np.array(self.video_paths),
+            num_frames=self.num_frames,
+            fps=self.fps,
+            num_audio_samples=self.num_audio_samples,
+            audio_sample_rate=self.audio_sample_rate,
+        )
+        if self.content_hashes is not None:
+            arrays["content_hashes"] = np.array(self.content_hashes)
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path: str):
+        with np.load(index_path) as index:
+            return cls(
+                index["video_paths"].tolist(),
+                index["num_frames"],
+                index["fps"],
+                index["num_audio_samples"],
+                int(index["audio_sample_rate"]),
+                index["content_hashes"].tolist() if "content_hashes" in index else None,
+            )
+
+    def get_content_hashes(self):
+        """
+        The content hash of every video by path, empty if the index has no content hashes
+        """
+        if self.content_hashes is None:
+            return {}
+        return dict(zip(self.video_paths, self.content_hashes))
+
+    def get_max_start_indices(self, num_frames: int, video_fps: int, mel_window_length: int = None):
+        """
+        The largest start frame of a window of `num_frames` frames of every video, such that the mel window of
+        `crop_audio_window` is complete too when `mel_window_length` is given. -1 when there is no such window
+        """
+        max_start_indices = self.num_frames - num_frames
+        if mel_window_length is None:
+            return np.maximum(max_start_indices, -1)
+
+        def mel_start(start_indices):
+            # Same as `crop_audio_window`
+            return (80.0 * (start_indices / float(video_fps))).astype(np.int64)
+
+        max_mel_start = self.num_mel_frames - mel_window_length
+        start_indices = np.floor(max_mel_start * video_fps / 80.0).astype(np.int64)
+        # Correct the rounding of the estimate
+        start_indices = np.where(mel_start(start_indices + 1) <= max_mel_start, start_indices + 1, start_indices)
+        start_indices = np.where(mel_start(start_indices) > max_mel_start, start_indices - 1, start_indices)
+        return np.maximum(np.minimum(max_start_indices, start_indices), -1)
+
+    def select(self, video_paths, num_frames: int, video_fps: int, min_num_frames: int, mel_window_length=None):
+        """
+        The videos of `video_paths` with at least `min_num_frames` frames and a valid window, see
+        `get_max_start_indices`, and the largest start frame of each of them. Videos missing from the index are
+        left out
+        """
+        positions = {video_path: i for i, video_path in enumerate(self.video_paths)}
+        max_start_indices = self.get_max_start_indices(num_frames, video_fps, mel_window_length)
+
+        selected_video_paths = []
+        selected_max_start_indices = []
+        for video_path in video_paths:
+            i = positions.get(video_path)
+            if i is None or self.num_frames[i] < min_num_frames or max_start_indices[i] < 0:
+                continue
+            selected_video_paths.append(video_path)
+            selected_max_start_indices.append(int(max_start_indices[i]))
+
+        if len(selected_video_paths) < len(video_paths):
+            print(f"{len(video_paths) - len(selected_video_paths)} videos without a valid window are skipped")
+        return selected_video_paths, selected_max_start_indices
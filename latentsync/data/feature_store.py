@@ -0,0 +1,197 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import glob
+import json
+from typing import Optional
+
+import numpy as np
+
+
+def _save_atomically(path: str, obj):
+    temp_path = f"{path}.tmp"
+    if isinstance(obj, np.ndarray):
+        with open(temp_path, "wb") as f:
+            np.save(f, obj)
+    else:
+        with open(temp_path, "w") as f:
+            json.dump(obj, f)
+    os.replace(temp_path, path)
+
+
+class FeatureStoreWriter:
+    """
+    Pack the features of many videos into a few large shard files. The features of a video are an array whose
+    first dimension is the time, all the arrays of a store must have the same row shape and dtype. The rows of
+    a video are stored contiguously, so that a window of consecutive time steps is a single read.
+
+    Several writers, e.g. one per process, can fill the same store directory as long as their `part_name` differ.
+    The index of a part is only written by `close`, a part that was not closed is ignored by `FeatureStore`. When
+    used as a context manager, an exception discards the part instead.
+    """
+
+    def __init__(self, store_dir: str, part_name: str = "part0", shard_size_bytes: int = 4 * 1024**3):
+        self.store_dir = store_dir
+        self.part_name = part_name
+        self.shard_size_bytes = shard_size_bytes
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.row_shape = None
+        self.dtype = None
+        self.shards = []  # [file name, number of rows]
+        self.keys = []
+        self.index = []  # [shard index, row offset in the shard, number of rows]
+        self._file = None
+        self._shard_bytes = 0
+
+    def _open_shard(self):
+        if self._file is not None:
+            self._file.close()
+        file_name = f"{self.part_name}_{len(self.shards):05d}.bin"
+        self._file = open(os.path.join(self.store_dir, file_name), "wb")
+        self._shard_bytes = 0
+        self.shards.append([file_name, 0])
+
+    def add(self, key: str, array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        if self.row_shape is None:
+            self.row_shape = list(array.shape[1:])
+            self.dtype = array.dtype.str
+        elif list(array.shape[1:]) != self.row_shape or array.dtype.str != self.dtype:
+            raise ValueError(
+                f"Expected rows of shape {self.row_shape} and dtype {self.dtype}, "
+                f"got {list(array.shape[1:])} and {array.dtype.str} for {key}"
+            )
+
+        if self._file is None or (self._shard_bytes > 0 and self._shard_bytes + array.nbytes > self.shard_size_bytes):
+            self._open_shard()
+        shard = self.shards[-1]
+        self._file.write(array.tobytes())
+        self._shard_bytes += array.nbytes
+        self.keys.append(key)
+        self.index.append([len(self.shards) - 1, shard[1], len(array)])
+        shard[1] += len(array)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        index_file = f"{self.part_name}_index.npy"
+        keys_file = f"{self.part_name}_keys.json"
+        _save_atomically(os.path.join(self.store_dir, index_file), np.array(self.index, dtype=np.int64).reshape(-1, 3))
+        _save_atomically(os.path.join(self.store_dir, keys_file), self.keys)
+        meta = dict(
+            row_shape=self.row_shape,
+            dtype=self.dtype,
+            shards=self.shards,
+            index_file=index_file,
+            keys_file=keys_file,
+        )
+        # The meta file is written last, it marks the part as complete
+        _save_atomically(os.path.join(self.store_dir, f"{self.part_name}_meta.json"), meta)
+
+    def abort(self):
+        """
+        Discard the shards written so far without marking the part as complete, e.g. after a crash mid-write
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        # Also the meta file of a previous run of the part, its shards were overwritten
+        file_names = [file_name for file_name, _ in self.shards] + [f"{self.part_name}_meta.json"]
+        for file_name in file_names:
+            path = os.path.join(self.store_dir, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FeatureStore:
+    """
+    Read access to a store written by `FeatureStoreWriter`. The shards are opened as `np.memmap` on first use, so
+    a store can be created before the dataloader workers are forked, and reading a window of rows only touches
+    the pages of that window.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.shard_paths = []
+        self.shard_num_rows = []
+        self.entries = {}  # key -> (shard index in the store, row offset, number of rows)
+        self.row_shape = None
+        self.dtype = None
+        self._memmaps = {}
+
+        for meta_path in sorted(glob.glob(os.path.join(store_dir, "*_meta.json"))):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["row_shape"] is None:  # empty part
+                continue
+            if self.row_shape is None:
+                self.row_shape = tuple(meta["row_shape"])
+                self.dtype = np.dtype(meta["dtype"])
+            elif tuple(meta["row_shape"]) != self.row_shape or np.dtype(meta["dtype"]) != self.dtype:
+                raise ValueError(f"{meta_path} does not match the rows of the other parts of the store")
+
+            shard_offset = len(self.shard_paths)
+            for file_name, num_rows in meta["shards"]:
+                self.shard_paths.append(os.path.join(store_dir, file_name))
+                self.shard_num_rows.append(num_rows)
+
+            index = np.load(os.path.join(store_dir, meta["index_file"]))
+            with open(os.path.join(store_dir, meta["keys_file"])) as f:
+                keys = json.load(f)
+            for key, (shard, offset, num_rows) in zip(keys, index.tolist()):
+                self.entries[key] = (shard_offset + shard, offset, num_rows)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def _get_memmap(self, shard: int) -> np.memmap:
+        memmap = self._memmaps.get(shard)
+        if memmap is None:
+            memmap = np.memmap(
+                self.shard_paths[shard],
+                dtype=self.dtype,
+                mode="r",
+                shape=(self.shard_num_rows[shard], *self.row_shape),
+            )
+            self._memmaps[shard] = memmap
+        return memmap
+
+    def get_num_rows(self, key: str) -> int:
+        return self.entries[key][2]
+
+    def read(self, key: str, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        """
+        Read the rows [start, end) of the features of `key`, clipped to the stored rows, as an in-memory array
+        """
+        shard, offset, num_rows = self.entries[key]
+        start = min(max(start, 0), num_rows)
+        end = num_rows if end is None else min(max(end, start), num_rows)
+        return np.array(self._get_memmap(shard)[offset + start : offset + end])
@@ -20,6 +20,8 @@ import random
 from ..utils.util import gather_video_paths_recursively
 from ..utils.image_processor import ImageProcessor
 from ..utils.audio import melspectrogram
+from .feature_store import FeatureStore
+from .dataset_index import DatasetIndex
 import math
 from pathlib import Path
 
@@ -46,6 +48,21 @@ class SyncNetDataset(Dataset):
         self.image_processor = ImageProcessor(resolution=config.data.resolution)
         self.audio_mel_cache_dir = config.data.audio_mel_cache_dir
         Path(self.audio_mel_cache_dir).mkdir(parents=True, exist_ok=True)
+        # Mel spectrograms packed by preprocess/build_feature_store.py, the per-video cache is the fallback
+        audio_mel_store_dir = getattr(config.data, "audio_mel_store_dir", "")
+        self.audio_mel_store = FeatureStore(audio_mel_store_dir) if audio_mel_store_dir else None
+
+        # Only sample videos and start frames with a complete window, according to preprocess/build_dataset_index.py
+        self.max_start_indices = None
+        dataset_index_path = getattr(config.data, "dataset_index_path", "")
+        if dataset_index_path != "":
+            self.video_paths, self.max_start_indices = DatasetIndex.load(dataset_index_path).select(
+                self.video_paths,
+                self.num_frames,
+                self.video_fps,
+                min_num_frames=2 * self.num_frames,
+                mel_window_length=self.mel_window_length,
+            )
 
     def __len__(self):
         return len(self.video_paths)
@@ -60,10 +77,19 @@ class SyncNetDataset(Dataset):
         end_idx = start_idx + self.mel_window_length
         return original_mel[:, start_idx:end_idx].unsqueeze(0)
 
-    def get_frames(self, video_reader: VideoReader):
+    def read_audio_window_from_store(self, video_path: str, start_index):
+        # The store holds the mel spectrogram transposed, (T, 80), so that the window is contiguous
+        start_idx = int(80.0 * (start_index / float(self.video_fps)))
+        end_idx = start_idx + self.mel_window_length
+        mel = self.audio_mel_store.read(video_path, start_idx, end_idx)
+        return torch.from_numpy(mel.T).unsqueeze(0)
+
+    def get_frames(self, video_reader: VideoReader, max_start_idx=None):
         total_num_frames = len(video_reader)
 
-        start_idx = random.randint(0, total_num_frames - self.num_frames)
+        if max_start_idx is None:
+            max_start_idx = total_num_frames - self.num_frames
+        start_idx = random.randint(0, max_start_idx)
         frames_index = np.arange(start_idx, start_idx + self.num_frames, dtype=int)
 
         while True:
@@ -78,62 +104,79 @@ class SyncNetDataset(Dataset):
 
         return frames, wrong_frames, start_idx
 
-    def worker_init_fn(self, worker_id):
-        self.worker_id = worker_id
+    def get_mel(self, video_path: str, start_idx: int):
+        if self.audio_mel_store is not None and video_path in self.audio_mel_store:
+            return self.read_audio_window_from_store(video_path, start_idx)
 
-    def __getitem__(self, idx):
-        while True:
+        mel_cache_path = os.path.join(
+            self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
+        )
+
+        if os.path.isfile(mel_cache_path):
             try:
-                idx = random.randint(0, len(self) - 1)
+                original_mel = torch.load(mel_cache_path, weights_only=True)
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {mel_cache_path}")
+                os.remove(mel_cache_path)
+                original_mel = self.read_audio(video_path)
+                torch.save(original_mel, mel_cache_path)
+        else:
+            original_mel = self.read_audio(video_path)
+            torch.save(original_mel, mel_cache_path)
 
-                # Get video file path
-                video_path = self.video_paths[idx]
+        return self.crop_audio_window(original_mel, start_idx)
 
-                vr = VideoReader(video_path, ctx=cpu(self.worker_id))
+    def worker_init_fn(self, worker_id):
+        self.worker_id = worker_id
 
-                if len(vr) < 2 * self.num_frames:
-                    continue
+    def load_sample(self, video_path: str, vr: VideoReader, max_start_idx=None, original_mel=None):
+        """
+        The sample of a random window of an opened video, None if the video or its audio is too short.
+        `original_mel` is the mel spectrogram of the whole video when it is already loaded, e.g. from a tar shard
+        """
+        if len(vr) < 2 * self.num_frames:
+            return None
 
-                frames, wrong_frames, start_idx = self.get_frames(vr)
+        frames, wrong_frames, start_idx = self.get_frames(vr, max_start_idx)
 
-                mel_cache_path = os.path.join(
-                    self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
-                )
+        if original_mel is None:
+            mel = self.get_mel(video_path, start_idx)
+        else:
+            mel = self.crop_audio_window(original_mel, start_idx)
 
-                if os.path.isfile(mel_cache_path):
-                    try:
-                        original_mel = torch.load(mel_cache_path, weights_only=True)
-                    except Exception as e:
-                        print(f"{type(e).__name__} - {e} - {mel_cache_path}")
-                        os.remove(mel_cache_path)
-                        original_mel = self.read_audio(video_path)
-                        torch.save(original_mel, mel_cache_path)
-                else:
-                    original_mel = self.read_audio(video_path)
-                    torch.save(original_mel, mel_cache_path)
+        if mel.shape[-1] != self.mel_window_length:
+            return None
 
-                mel = self.crop_audio_window(original_mel, start_idx)
+        if random.choice([True, False]):
+            y = torch.ones(1).float()
+            chosen_frames = frames
+        else:
+            y = torch.zeros(1).float()
+            chosen_frames = wrong_frames
 
-                if mel.shape[-1] != self.mel_window_length:
-                    continue
+        chosen_frames = self.image_processor.process_images(chosen_frames)
 
-                if random.choice([True, False]):
-                    y = torch.ones(1).float()
-                    chosen_frames = frames
-                else:
-                    y = torch.zeros(1).float()
-                    chosen_frames = wrong_frames
+        sample = dict(frames=chosen_frames, audio_samples=mel, y=y)
+
+        return sample
+
+    def __getitem__(self, idx):
+        while True:
+            try:
+                idx = random.randint(0, len(self) - 1)
 
-                chosen_frames = self.image_processor.process_images(chosen_frames)
+                # Get video file path
+                video_path = self.video_paths[idx]
 
+                vr = VideoReader(video_path, ctx=cpu(self.worker_id))
+                max_start_idx = None if self.max_start_indices is None else self.max_start_indices[idx]
+                sample = self.load_sample(video_path, vr, max_start_idx)
                 vr.seek(0)  # avoid memory leak
-                break
+
+                if sample is not None:
+                    return sample
 
             except Exception as e:  # Handle the exception of face not detcted
                 print(f"{type(e).__name__} - {e} - {video_path}")
                 if "vr" in locals():
                     vr.seek(0)  # avoid memory leak
-
-        sample = dict(frames=chosen_frames, audio_samples=mel, y=y)
-
-        return sample
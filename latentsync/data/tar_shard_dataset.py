@@ -0,0 +1,275 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import hashlib
+import glob
+import json
+import random
+import tarfile
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from decord import VideoReader, cpu
+
+
+class TarShardWriter:
+    """
+    Pack the clips of many videos into a few large tar shards, read sequentially by `TarShardDataset`. A clip is a
+    group of consecutive tar members named `<key>.<ext>`, e.g. `000000042.mp4`, `000000042.json` and
+    `000000042.mel.pt`.
+
+    Several writers, e.g. one per process, can fill the same directory as long as their `part_name` differ. A shard
+    is renamed to its final name once complete, and the list of shards of a part is only written by `close`. When
+    used as a context manager, an exception discards the part instead.
+    """
+
+    def __init__(self, shards_dir: str, part_name: str = "part0", shard_size_bytes: int = 2 * 1024**3):
+        self.shards_dir = shards_dir
+        self.part_name = part_name
+        self.shard_size_bytes = shard_size_bytes
+        os.makedirs(shards_dir, exist_ok=True)
+
+        self.shards = []  # [file name, number of clips]
+        self._tar = None
+        self._shard_bytes = 0
+
+    def _close_shard(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        shard_path = os.path.join(self.shards_dir, self.shards[-1][0])
+        os.replace(f"{shard_path}.tmp", shard_path)
+        self._tar = None
+
+    def _open_shard(self):
+        self._close_shard()
+        file_name = f"{self.part_name}_{len(self.shards):05d}.tar"
+        self._tar = tarfile.open(os.path.join(self.shards_dir, f"{file_name}.tmp"), "w")
+        self._shard_bytes = 0
+        self.shards.append([file_name, 0])
+
+    def add(self, files: dict):
+        """
+        :param files: the content of every file of the clip, by extension
+        """
+        clip_bytes = sum(len(data) for data in files.values())
+        if self._tar is None or (self._shard_bytes > 0 and self._shard_bytes + clip_bytes > self.shard_size_bytes):
+            self._open_shard()
+        shard = self.shards[-1]
+        key = f"{sum(num_clips for _, num_clips in self.shards):09d}"
+        for ext, data in files.items():
+            tar_info = tarfile.TarInfo(f"{key}.{ext}")
+            tar_info.size = len(data)
+            self._tar.addfile(tar_info, io.BytesIO(data))
+        shard[1] += 1
+        self._shard_bytes += clip_bytes
+
+    def close(self):
+        self._close_shard()
+        temp_path = os.path.join(self.shards_dir, f"{self.part_name}.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"shards": self.shards}, f)
+        os.replace(temp_path, os.path.join(self.shards_dir, f"{self.part_name}.json"))
+
+    def abort(self):
+        """
+        Discard the shards written so far without listing the part, e.g. after a crash mid-write
+        """
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+            os.remove(os.path.join(self.shards_dir, f"{self.shards[-1][0]}.tmp"))
+            self.shards.pop()
+
+        # Also the list of a previous run of the part, its shards were overwritten
+        file_names = [file_name for file_name, _ in self.shards] + [f"{self.part_name}.json"]
+        for file_name in file_names:
+            path = os.path.join(self.shards_dir, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_shard_list(shards_dir: str):
+    """
+    [shard path, number of clips] of all the closed parts of a directory of shards
+    """
+    shards = []
+    for part_path in sorted(glob.glob(os.path.join(shards_dir, "*.json"))):
+        with open(part_path) as f:
+            part = json.load(f)
+        shards.extend([os.path.join(shards_dir, file_name), num_clips] for file_name, num_clips in part["shards"])
+    if len(shards) == 0:
+        raise FileNotFoundError(f"No tar shards in {shards_dir}")
+    return shards
+
+
+def iter_tar_shard(shard_path: str):
+    """
+    The files of every clip of a shard by extension, in order, with a single sequential read of the shard
+    """
+    with tarfile.open(shard_path, "r|") as tar:
+        key, files = None, {}
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, ext = member.name.split(".", 1)
+            if member_key != key:
+                if key is not None:
+                    yield files
+                key, files = member_key, {}
+            files[ext] = tar.extractfile(member).read()
+        if key is not None:
+            yield files
+
+
+class TarShardDataset(IterableDataset):
+    """
+    Streams the clips packed by preprocess/pack_tar_shards.py instead of opening random videos, the samples are
+    made by `dataset.load_sample` of a `UNetDataset` or `SyncNetDataset`. The shards are split between the ranks
+    and the dataloader workers, each worker reads its shards in a random order and shuffles the clips in a buffer
+    of `shuffle_buffer_size` clips. The buffer holds the packed files, a clip is only decoded when drawn from it.
+
+    Every worker yields the same number of samples, such that all ranks run the same number of steps per epoch,
+    so a worker reads its shards again if they run out.
+    """
+
+    def __init__(
+        self,
+        shards_dir: str,
+        dataset,
+        shuffle_buffer_size: int = 1000,
+        rank: int = 0,
+        world_size: int = 1,
+        seed: int = 0,
+    ):
+        self.shards = read_shard_list(shards_dir)
+        self.dataset = dataset
+        self.shuffle_buffer_size = max(shuffle_buffer_size, 1)
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_clips = sum(num_clips for _, num_clips in self.shards)
+        if len(self.shards) < world_size:
+            print(f"Only {len(self.shards)} shards for {world_size} ranks, some shards are read by several ranks")
+
+    def __len__(self):
+        return self.num_clips // self.world_size
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def worker_init_fn(self, worker_id):
+        self.dataset.worker_init_fn(worker_id)
+
+    def get_worker_shards(self, worker_id: int, num_workers: int):
+        # The same order on every rank and worker, so that their shards are disjoint
+        shard_indices = list(range(len(self.shards)))
+        random.Random(self.seed + self.epoch).shuffle(shard_indices)
+        num_slots = self.world_size * num_workers
+        slot = self.rank * num_workers + worker_id
+        # With fewer shards than slots, some shards are read by several slots
+        return [
+            shard_indices[i % len(shard_indices)] for i in range(slot, max(len(shard_indices), num_slots), num_slots)
+        ]
+
+    def load_sample(self, files: dict):
+        metadata = json.loads(files["json"])
+        kwargs = {}
+        if "mel.pt" in files:
+            kwargs["original_mel"] = torch.load(io.BytesIO(files["mel.pt"]), weights_only=True)
+        if getattr(self.dataset, "audio_embeds_reader", None) is not None:
+            if "embeds.pt" in files:
+                kwargs["audio_feat"] = torch.load(io.BytesIO(files["embeds.pt"]), weights_only=True)
+            else:
+                # Look up the embedding cache with the hash of the packed video, the original path is never read
+                content_hash = metadata.get("content_hash")
+                if content_hash is None:
+                    content_hash = hashlib.sha256(files["mp4"]).hexdigest()
+                kwargs["audio_content_hash"] = content_hash
+
+        vr = VideoReader(io.BytesIO(files["mp4"]), ctx=cpu(self.dataset.worker_id))
+        try:
+            return self.dataset.load_sample(metadata["video_path"], vr, **kwargs)
+        finally:
+            vr.seek(0)  # avoid memory leak
+
+    def try_load_sample(self, shard_path: str, files: dict):
+        try:
+            return self.load_sample(files)
+        except Exception as e:
+            print(f"{type(e).__name__} - {e} - {shard_path}")
+            return None
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            self.dataset.worker_init_fn(0)
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        shard_indices = self.get_worker_shards(worker_id, num_workers)
+        num_samples = len(self) // num_workers
+        if num_samples == 0:
+            return
+        rng = random.Random(f"{self.seed}_{self.epoch}_{self.rank}_{worker_id}")
+
+        # The buffer holds the packed files of the clips, a clip is only decoded once drawn from the buffer
+        buffer = []
+        num_yielded = 0
+        while True:
+            num_loaded = 0
+            rng.shuffle(shard_indices)
+            for shard_index in shard_indices:
+                shard_path = self.shards[shard_index][0]
+                for files in iter_tar_shard(shard_path):
+                    if len(buffer) < self.shuffle_buffer_size:
+                        buffer.append((shard_path, files))
+                        continue
+                    i = rng.randrange(len(buffer))
+                    buffer[i], drawn = (shard_path, files), buffer[i]
+                    sample = self.try_load_sample(*drawn)
+                    if sample is None:
+                        continue
+                    num_loaded += 1
+                    yield sample
+                    num_yielded += 1
+                    if num_yielded == num_samples:
+                        return
+
+            # Fewer samples left than in the buffer, or fewer clips in the shards than the buffer holds
+            if len(buffer) >= num_samples - num_yielded or num_loaded == 0:
+                rng.shuffle(buffer)
+                while len(buffer) > 0:
+                    sample = self.try_load_sample(*buffer.pop())
+                    if sample is None:
+                        continue
+                    num_loaded += 1
+                    yield sample
+                    num_yielded += 1
+                    if num_yielded == num_samples:
+                        return
+            if num_loaded == 0:
+                raise RuntimeError(f"No valid clip in the shards {[self.shards[i][0] for i in shard_indices]}")
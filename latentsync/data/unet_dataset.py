@@ -19,15 +19,18 @@ from torch.utils.data import Dataset
 import torch
 import random
 import cv2
+from einops import rearrange
 from ..utils.image_processor import ImageProcessor, load_fixed_mask
 from ..utils.audio import melspectrogram
+from .feature_store import FeatureStore
+from .dataset_index import DatasetIndex
 from decord import AudioReader, VideoReader, cpu
 import torch.nn.functional as F
 from pathlib import Path
 
 
 class UNetDataset(Dataset):
-    def __init__(self, train_data_dir: str, config):
+    def __init__(self, train_data_dir: str, config, audio_embeds_reader=None):
         if config.data.train_fileslist != "":
             with open(config.data.train_fileslist) as file:
                 self.video_paths = [line.rstrip() for line in file]
@@ -50,8 +53,31 @@ class UNetDataset(Dataset):
             self.resolution, mask_image=load_fixed_mask(self.resolution, config.data.mask_image_path)
         )
         self.load_audio_data = config.model.add_audio_layer and config.run.use_syncnet
+        # Return the uint8 frames, resized, normalized and masked on the GPU for the whole batch by the training loop
+        self.gpu_image_processing = getattr(config.data, "gpu_image_processing", False)
+        # Crops the whisper embeddings in the workers, the training loop computes the missing ones
+        self.audio_embeds_reader = audio_embeds_reader
         self.audio_mel_cache_dir = config.data.audio_mel_cache_dir
         Path(self.audio_mel_cache_dir).mkdir(parents=True, exist_ok=True)
+        # Mel spectrograms packed by preprocess/build_feature_store.py, the per-video cache is the fallback
+        audio_mel_store_dir = getattr(config.data, "audio_mel_store_dir", "")
+        self.audio_mel_store = FeatureStore(audio_mel_store_dir) if audio_mel_store_dir else None
+
+        # Only sample videos and start frames with a complete window, according to preprocess/build_dataset_index.py
+        self.max_start_indices = None
+        dataset_index_path = getattr(config.data, "dataset_index_path", "")
+        if dataset_index_path != "":
+            dataset_index = DatasetIndex.load(dataset_index_path)
+            self.video_paths, self.max_start_indices = dataset_index.select(
+                self.video_paths,
+                self.num_frames,
+                self.video_fps,
+                min_num_frames=3 * self.num_frames,
+                mel_window_length=self.mel_window_length if self.load_audio_data else None,
+            )
+            if self.audio_embeds_reader is not None:
+                # The workers look up the embedding cache with the content hashes of the index
+                self.audio_embeds_reader.content_hashes.update(dataset_index.get_content_hashes())
 
     def __len__(self):
         return len(self.video_paths)
@@ -66,10 +92,17 @@ class UNetDataset(Dataset):
         end_idx = start_idx + self.mel_window_length
         return original_mel[:, start_idx:end_idx].unsqueeze(0)
 
-    def get_frames(self, video_reader: VideoReader):
-        total_num_frames = len(video_reader)
+    def read_audio_window_from_store(self, video_path: str, start_index):
+        # The store holds the mel spectrogram transposed, (T, 80), so that the window is contiguous
+        start_idx = int(80.0 * (start_index / float(self.video_fps)))
+        end_idx = start_idx + self.mel_window_length
+        mel = self.audio_mel_store.read(video_path, start_idx, end_idx)
+        return torch.from_numpy(mel.T).unsqueeze(0)
 
-        start_idx = random.randint(0, total_num_frames - self.num_frames)
+    def get_frame_indices(self, total_num_frames: int, max_start_idx=None):
+        if max_start_idx is None:
+            max_start_idx = total_num_frames - self.num_frames
+        start_idx = random.randint(0, max_start_idx)
         gt_frames_index = np.arange(start_idx, start_idx + self.num_frames, dtype=int)
 
         while True:
@@ -79,65 +112,103 @@ class UNetDataset(Dataset):
             ref_frames_index = np.arange(ref_start_idx, ref_start_idx + self.num_frames, dtype=int)
             break
 
+        return gt_frames_index, ref_frames_index, start_idx
+
+    def get_frames(self, video_reader: VideoReader, max_start_idx=None):
+        gt_frames_index, ref_frames_index, start_idx = self.get_frame_indices(len(video_reader), max_start_idx)
+
         gt_frames = video_reader.get_batch(gt_frames_index).asnumpy()
         ref_frames = video_reader.get_batch(ref_frames_index).asnumpy()
 
         return gt_frames, ref_frames, start_idx
 
-    def worker_init_fn(self, worker_id):
-        self.worker_id = worker_id
+    def get_mel(self, video_path: str, start_idx: int):
+        if self.audio_mel_store is not None and video_path in self.audio_mel_store:
+            return self.read_audio_window_from_store(video_path, start_idx)
 
-    def __getitem__(self, idx):
-        while True:
-            try:
-                idx = random.randint(0, len(self) - 1)
-
-                # Get video file path
-                video_path = self.video_paths[idx]
-
-                vr = VideoReader(video_path, ctx=cpu(self.worker_id))
-
-                if len(vr) < 3 * self.num_frames:
-                    continue
-
-                gt_frames, ref_frames, start_idx = self.get_frames(vr)
-
-                if self.load_audio_data:
-                    mel_cache_path = os.path.join(
-                        self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
-                    )
+        mel_cache_path = os.path.join(
+            self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
+        )
 
-                    if os.path.isfile(mel_cache_path):
-                        try:
-                            original_mel = torch.load(mel_cache_path, weights_only=True)
-                        except Exception as e:
-                            print(f"{type(e).__name__} - {e} - {mel_cache_path}")
-                            os.remove(mel_cache_path)
-                            original_mel = self.read_audio(video_path)
-                            torch.save(original_mel, mel_cache_path)
-                    else:
-                        original_mel = self.read_audio(video_path)
-                        torch.save(original_mel, mel_cache_path)
+        if os.path.isfile(mel_cache_path):
+            try:
+                original_mel = torch.load(mel_cache_path, weights_only=True)
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {mel_cache_path}")
+                os.remove(mel_cache_path)
+                original_mel = self.read_audio(video_path)
+                torch.save(original_mel, mel_cache_path)
+        else:
+            original_mel = self.read_audio(video_path)
+            torch.save(original_mel, mel_cache_path)
 
-                    mel = self.crop_audio_window(original_mel, start_idx)
+        return self.crop_audio_window(original_mel, start_idx)
 
-                    if mel.shape[-1] != self.mel_window_length:
-                        continue
-                else:
-                    mel = []
+    def get_max_start_idx(self, idx: int):
+        return None if self.max_start_indices is None else self.max_start_indices[idx]
 
-                gt_pixel_values, masked_pixel_values, masks = self.image_processor.prepare_masks_and_masked_images(
-                    gt_frames, affine_transform=False
-                )  # (f, c, h, w)
-                ref_pixel_values = self.image_processor.process_images(ref_frames)
+    def add_audio_embeds(self, sample: dict, audio_feat=None, audio_content_hash=None):
+        if self.audio_embeds_reader is None:
+            return sample
+        if audio_feat is None:
+            audio_embeds = self.audio_embeds_reader.read(sample["video_path"], sample["start_idx"], audio_content_hash)
+        else:
+            audio_embeds = self.audio_embeds_reader.crop_overlap_audio_window(audio_feat, sample["start_idx"])
+        sample["audio_embeds_available"] = audio_embeds is not None
+        if audio_embeds is None:
+            audio_embeds = torch.zeros(self.audio_embeds_reader.embeds_shape)
+        # The same dtype for the store and the cache so that the batch can be collated
+        sample["audio_embeds"] = audio_embeds.to(torch.float16)
+        return sample
 
-                vr.seek(0)  # avoid memory leak
-                break
+    def worker_init_fn(self, worker_id):
+        self.worker_id = worker_id
 
-            except Exception as e:  # Handle the exception of face not detcted
-                print(f"{type(e).__name__} - {e} - {video_path}")
-                if "vr" in locals():
-                    vr.seek(0)  # avoid memory leak
+    def load_sample(
+        self,
+        video_path: str,
+        vr: VideoReader,
+        max_start_idx=None,
+        original_mel=None,
+        audio_feat=None,
+        audio_content_hash=None,
+    ):
+        """
+        The sample of a random window of an opened video, None if the video or its audio is too short.
+        `original_mel` and `audio_feat` are the mel spectrogram and the whisper embeddings of the whole video when
+        they are already loaded, e.g. from a tar shard, otherwise they are read from the stores and caches.
+        `audio_content_hash` is the key of the video in the embedding cache when it is not in the dataset index
+        """
+        if len(vr) < 3 * self.num_frames:
+            return None
+
+        gt_frames, ref_frames, start_idx = self.get_frames(vr, max_start_idx)
+
+        if self.load_audio_data:
+            if original_mel is None:
+                mel = self.get_mel(video_path, start_idx)
+            else:
+                mel = self.crop_audio_window(original_mel, start_idx)
+
+            if mel.shape[-1] != self.mel_window_length:
+                return None
+        else:
+            mel = []
+
+        if self.gpu_image_processing:
+            sample = dict(
+                gt_frames=rearrange(torch.from_numpy(gt_frames), "f h w c -> f c h w"),
+                ref_frames=rearrange(torch.from_numpy(ref_frames), "f h w c -> f c h w"),
+                mel=mel,
+                video_path=video_path,
+                start_idx=start_idx,
+            )
+            return self.add_audio_embeds(sample, audio_feat, audio_content_hash)
+
+        gt_pixel_values, masked_pixel_values, masks = self.image_processor.prepare_masks_and_masked_images(
+            gt_frames, affine_transform=False
+        )  # (f, c, h, w)
+        ref_pixel_values = self.image_processor.process_images(ref_frames)
 
         sample = dict(
             gt_pixel_values=gt_pixel_values,
@@ -149,4 +220,24 @@ class UNetDataset(Dataset):
             start_idx=start_idx,
         )
 
-        return sample
+        return self.add_audio_embeds(sample, audio_feat, audio_content_hash)
+
+    def __getitem__(self, idx):
+        while True:
+            try:
+                idx = random.randint(0, len(self) - 1)
+
+                # Get video file path
+                video_path = self.video_paths[idx]
+
+                vr = VideoReader(video_path, ctx=cpu(self.worker_id))
+                sample = self.load_sample(video_path, vr, self.get_max_start_idx(idx))
+                vr.seek(0)  # avoid memory leak
+
+                if sample is not None:
+                    return sample
+
+            except Exception as e:  # Handle the exception of face not detcted
+                print(f"{type(e).__name__} - {e} - {video_path}")
+                if "vr" in locals():
+                    vr.seek(0)  # avoid memory leak
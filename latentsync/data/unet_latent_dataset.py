@@ -0,0 +1,102 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import torch
+from einops import rearrange
+from decord import VideoReader, cpu
+
+from .unet_dataset import UNetDataset
+from .feature_store import FeatureStore
+
+
+class UNetLatentDataset(UNetDataset):
+    """
+    Serves the VAE latent distributions precomputed by preprocess/extract_vae_latents.py instead of the frames,
+    with the same gt/ref window sampling as `UNetDataset`. Every row of the latent store holds the distribution
+    parameters (mean and log-variance) of a frame and of its masked frame, so the training samples the latents
+    without running the VAE encoder. The gt frames are only read for the pixel space losses.
+    """
+
+    def __init__(self, train_data_dir: str, config, audio_embeds_reader=None):
+        super().__init__(train_data_dir, config, audio_embeds_reader)
+        self.latent_store = FeatureStore(config.data.latent_store_dir)
+        selected = [i for i, video_path in enumerate(self.video_paths) if video_path in self.latent_store]
+        if len(selected) < len(self.video_paths):
+            print(f"{len(self.video_paths) - len(selected)} videos without latents are skipped")
+        self.video_paths = [self.video_paths[i] for i in selected]
+        if self.max_start_indices is not None:
+            self.max_start_indices = [self.max_start_indices[i] for i in selected]
+        self.load_pixel_values = config.run.pixel_space_supervise
+        self.masks = self.image_processor.mask_image[0:1].float()
+
+    def __getitem__(self, idx):
+        while True:
+            try:
+                idx = random.randint(0, len(self) - 1)
+
+                # Get video file path
+                video_path = self.video_paths[idx]
+
+                total_num_frames = self.latent_store.get_num_rows(video_path)
+                if total_num_frames < 3 * self.num_frames:
+                    continue
+
+                gt_frames_index, ref_frames_index, start_idx = self.get_frame_indices(
+                    total_num_frames, self.get_max_start_idx(idx)
+                )
+
+                if self.load_audio_data:
+                    mel = self.get_mel(video_path, start_idx)
+
+                    if mel.shape[-1] != self.mel_window_length:
+                        continue
+                else:
+                    mel = []
+
+                # (f, 2, 2 * c, h, w), the parameters of the frame and of the masked frame
+                gt_latent_params = self.latent_store.read(video_path, start_idx, start_idx + self.num_frames)
+                ref_start_idx = int(ref_frames_index[0])
+                ref_latent_params = self.latent_store.read(video_path, ref_start_idx, ref_start_idx + self.num_frames)
+
+                if self.load_pixel_values:
+                    vr = VideoReader(video_path, ctx=cpu(self.worker_id))
+                    gt_pixel_values = vr.get_batch(gt_frames_index).asnumpy()
+                    if self.gpu_image_processing:
+                        # uint8 frames, see `UNetDataset`
+                        gt_pixel_values = rearrange(torch.from_numpy(gt_pixel_values), "f h w c -> f c h w")
+                    else:
+                        gt_pixel_values = self.image_processor.process_images(gt_pixel_values)
+                    vr.seek(0)  # avoid memory leak
+                else:
+                    gt_pixel_values = []
+                break
+
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {video_path}")
+                if "vr" in locals():
+                    vr.seek(0)  # avoid memory leak
+
+        sample = dict(
+            gt_latent_params=torch.from_numpy(gt_latent_params[:, 0]),
+            masked_latent_params=torch.from_numpy(gt_latent_params[:, 1]),
+            ref_latent_params=torch.from_numpy(ref_latent_params[:, 0]),
+            gt_pixel_values=gt_pixel_values,
+            mel=mel,
+            masks=self.masks.expand(self.num_frames, -1, -1, -1),
+            video_path=video_path,
+            start_idx=start_idx,
+        )
+
+        return self.add_audio_embeds(sample)
@@ -1,5 +1,7 @@
 # Adapted from https://github.com/huggingface/diffusers/blob/main/src/diffusers/models/attention.py
 
+import threading
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import Optional
 
@@ -15,6 +17,48 @@ from diffusers.models.attention import FeedForward, AdaLayerNorm
 from einops import rearrange, repeat
 
 
+class CrossAttentionCache:
+    """
+    The projected key and value of the audio cross-attention layers, reused for every denoising step as long as the
+    same `encoder_hidden_states` tensor is passed. A cache belongs to a single denoising loop, so concurrent loops
+    sharing the model never see each other's keys and values, and the cache is released with the loop. Only for
+    inference, the cached key and value are not recomputed for the backward pass.
+    """
+
+    def __init__(self):
+        self.encoder_hidden_states = None
+        self.version = None
+        self.key_values = {}
+
+    def update(self, encoder_hidden_states: torch.Tensor):
+        # The tensor is kept alive by the reference, so the identity check can't be fooled by a reused address,
+        # and the version counter catches in-place updates
+        if self.encoder_hidden_states is not encoder_hidden_states or self.version != encoder_hidden_states._version:
+            self.key_values.clear()
+            self.encoder_hidden_states = encoder_hidden_states
+            self.version = encoder_hidden_states._version
+
+
+# The cache of the forward pass running in the current thread
+_active_cross_attention_cache = threading.local()
+
+
+@contextmanager
+def use_cross_attention_cache(cache: CrossAttentionCache, encoder_hidden_states: Optional[torch.Tensor]):
+    """
+    Use `cache` in the audio cross-attention layers of the forward passes of the model run by the current thread
+    within the context, `encoder_hidden_states` being the ones passed to the model
+    """
+    if encoder_hidden_states is not None:
+        cache.update(encoder_hidden_states)
+    previous_cache = getattr(_active_cross_attention_cache, "cache", None)
+    _active_cross_attention_cache.cache = cache if encoder_hidden_states is not None else None
+    try:
+        yield
+    finally:
+        _active_cross_attention_cache.cache = previous_cache
+
+
 @dataclass
 class Transformer3DModelOutput(BaseOutput):
     sample: torch.FloatTensor
@@ -164,6 +208,7 @@ class BasicTransformerBlock(nn.Module):
                 bias=attention_bias,
                 upcast_attention=upcast_attention,
             )
+            self.attn2.cache_key_value = True
         else:
             self.attn2 = None
 
@@ -235,6 +280,11 @@ class Attention(nn.Module):
         self.to_out.append(nn.Linear(inner_dim, query_dim))
         self.to_out.append(nn.Dropout(dropout))
 
+        # Whether the projected key and value of the encoder hidden states can be kept in the active
+        # `CrossAttentionCache`, only for the audio cross-attention whose encoder hidden states are the same at every
+        # denoising step
+        self.cache_key_value = False
+
     def split_heads(self, tensor):
         batch_size, seq_len, dim = tensor.shape
         tensor = tensor.reshape(batch_size, seq_len, self.heads, dim // self.heads)
@@ -247,6 +297,11 @@ class Attention(nn.Module):
         tensor = tensor.reshape(batch_size, seq_len, heads * head_dim)
         return tensor
 
+    def get_key_value(self, hidden_states):
+        key = self.split_heads(self.to_k(hidden_states))
+        value = self.split_heads(self.to_v(hidden_states))
+        return key, value
+
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
         if self.group_norm is not None:
             hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
@@ -254,12 +309,16 @@ class Attention(nn.Module):
         query = self.to_q(hidden_states)
         query = self.split_heads(query)
 
-        encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
-        key = self.to_k(encoder_hidden_states)
-        value = self.to_v(encoder_hidden_states)
-
-        key = self.split_heads(key)
-        value = self.split_heads(value)
+        if encoder_hidden_states is None:
+            key, value = self.get_key_value(hidden_states)
+        else:
+            cache = getattr(_active_cross_attention_cache, "cache", None) if self.cache_key_value else None
+            if cache is None:
+                key, value = self.get_key_value(encoder_hidden_states)
+            else:
+                if self not in cache.key_values:
+                    cache.key_values[self] = self.get_key_value(encoder_hidden_states)
+                key, value = cache.key_values[self]
 
         if attention_mask is not None:
             if attention_mask.shape[-1] != query.shape[1]:
@@ -3,9 +3,7 @@
 import inspect
 import math
 import os
-import shutil
 from typing import Callable, List, Optional, Union
-import subprocess
 
 import numpy as np
 import torch
@@ -16,6 +14,7 @@ from packaging import version
 
 from diffusers.configuration_utils import FrozenDict
 from diffusers.models import AutoencoderKL
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.pipelines import DiffusionPipeline
 from diffusers.schedulers import (
     DDIMScheduler,
@@ -31,11 +30,20 @@ from einops import rearrange
 import cv2
 
 from ..models.unet import UNet3DConditionModel
-from ..utils.util import read_video, read_audio, write_video, check_ffmpeg_installed
+from ..models.attention import CrossAttentionCache, use_cross_attention_cache
+from ..utils.util import (
+    read_video,
+    read_audio,
+    check_ffmpeg_installed,
+    loop_video_indices,
+    FFmpegVideoWriter,
+    VideoFrameReader,
+)
 from ..utils.image_processor import ImageProcessor, load_fixed_mask
+from ..utils.stage_executor import StageExecutor
+from ..utils.avatar_cache import AvatarCache
 from ..whisper.audio2feature import Audio2Feature
 import tqdm
-import soundfile as sf
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -117,6 +125,7 @@ class LipsyncPipeline(DiffusionPipeline):
         )
 
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        self.avatar_cache = None
 
         self.set_progress_bar_config(desc="Steps")
 
@@ -126,6 +135,12 @@ class LipsyncPipeline(DiffusionPipeline):
     def disable_vae_slicing(self):
         self.vae.disable_slicing()
 
+    def enable_avatar_cache(self, cache_dir: str, max_size_bytes: int = 20 * 1024**3):
+        self.avatar_cache = AvatarCache(cache_dir, max_size_bytes)
+
+    def disable_avatar_cache(self):
+        self.avatar_cache = None
+
     @property
     def _execution_device(self):
         if self.device != torch.device("meta") or not hasattr(self.denoising_unet, "_hf_hook"):
@@ -192,8 +207,24 @@ class LipsyncPipeline(DiffusionPipeline):
         latents = latents * self.scheduler.init_noise_sigma
         return latents
 
+    def encode_latent_dist(self, images, device, dtype, latent_params=None):
+        # Precomputed distribution parameters, e.g. from the avatar cache, skip the VAE encoder
+        if latent_params is not None:
+            return DiagonalGaussianDistribution(latent_params.to(device=device, dtype=dtype))
+        images = images.to(device=device, dtype=dtype)
+        return self.vae.encode(images).latent_dist
+
     def prepare_mask_latents(
-        self, mask, masked_image, height, width, dtype, device, generator, do_classifier_free_guidance
+        self,
+        mask,
+        masked_image,
+        height,
+        width,
+        dtype,
+        device,
+        generator,
+        do_classifier_free_guidance,
+        latent_params=None,
     ):
         # resize the mask to latents shape as we concatenate the mask to the latents
         # we do that before converting to dtype to avoid breaking in case we're using cpu_offload
@@ -201,10 +232,10 @@ class LipsyncPipeline(DiffusionPipeline):
         mask = torch.nn.functional.interpolate(
             mask, size=(height // self.vae_scale_factor, width // self.vae_scale_factor)
         )
-        masked_image = masked_image.to(device=device, dtype=dtype)
-
         # encode the mask image into latents space so we can concatenate it to the latents
-        masked_image_latents = self.vae.encode(masked_image).latent_dist.sample(generator=generator)
+        masked_image_latents = self.encode_latent_dist(masked_image, device, dtype, latent_params).sample(
+            generator=generator
+        )
         masked_image_latents = (masked_image_latents - self.vae.config.shift_factor) * self.vae.config.scaling_factor
 
         # aligning device to prevent device errors when concating it with the latent model input
@@ -221,9 +252,8 @@ class LipsyncPipeline(DiffusionPipeline):
         )
         return mask, masked_image_latents
 
-    def prepare_image_latents(self, images, device, dtype, generator, do_classifier_free_guidance):
-        images = images.to(device=device, dtype=dtype)
-        image_latents = self.vae.encode(images).latent_dist.sample(generator=generator)
+    def prepare_image_latents(self, images, device, dtype, generator, do_classifier_free_guidance, latent_params=None):
+        image_latents = self.encode_latent_dist(images, device, dtype, latent_params).sample(generator=generator)
         image_latents = (image_latents - self.vae.config.shift_factor) * self.vae.config.scaling_factor
         image_latents = rearrange(image_latents, "f c h w -> 1 c f h w")
         image_latents = torch.cat([image_latents] * 2) if do_classifier_free_guidance else image_latents
@@ -251,12 +281,13 @@ class LipsyncPipeline(DiffusionPipeline):
         images = images.cpu().numpy()
         return images
 
-    def affine_transform_video(self, video_frames: np.ndarray):
+    def affine_transform_video(self, video_frames: np.ndarray, verbose: bool = True):
         faces = []
         boxes = []
         affine_matrices = []
-        print(f"Affine transforming {len(video_frames)} faces...")
-        for frame in tqdm.tqdm(video_frames):
+        if verbose:
+            print(f"Affine transforming {len(video_frames)} faces...")
+        for frame in tqdm.tqdm(video_frames, disable=not verbose):
             face, box, affine_matrix = self.image_processor.affine_transform(frame)
             faces.append(face)
             boxes.append(box)
@@ -265,22 +296,37 @@ class LipsyncPipeline(DiffusionPipeline):
         faces = torch.stack(faces)
         return faces, boxes, affine_matrices
 
-    def restore_video(self, faces: torch.Tensor, video_frames: np.ndarray, boxes: list, affine_matrices: list):
+    def restore_video(
+        self,
+        faces: torch.Tensor,
+        video_frames: np.ndarray,
+        boxes: list,
+        affine_matrices: list,
+        verbose: bool = True,
+        restore_batch_size: int = 16,
+    ):
+        # The faces are pasted back into the frames in place
         video_frames = video_frames[: len(faces)]
-        out_frames = []
-        print(f"Restoring {len(faces)} faces...")
-        for index, face in enumerate(tqdm.tqdm(faces)):
-            x1, y1, x2, y2 = boxes[index]
-            height = int(y2 - y1)
-            width = int(x2 - x1)
-            face = torchvision.transforms.functional.resize(
-                face, size=(height, width), interpolation=transforms.InterpolationMode.BICUBIC, antialias=True
+        if verbose:
+            print(f"Restoring {len(faces)} faces...")
+        # The boxes span the aligned face, whose size is the same for every frame
+        x1, y1, x2, y2 = boxes[0]
+        height = int(y2 - y1)
+        width = int(x2 - x1)
+        for start in tqdm.tqdm(range(0, len(faces), restore_batch_size), disable=not verbose):
+            end = start + restore_batch_size
+            batch_faces = torchvision.transforms.functional.resize(
+                faces[start:end],
+                size=(height, width),
+                interpolation=transforms.InterpolationMode.BICUBIC,
+                antialias=True,
+            )
+            self.image_processor.restorer.restore_batch(
+                video_frames[start:end], batch_faces, affine_matrices[start:end]
             )
-            out_frame = self.image_processor.restorer.restore_img(video_frames[index], face, affine_matrices[index])
-            out_frames.append(out_frame)
-        return np.stack(out_frames, axis=0)
+        return video_frames
 
-    def loop_video(self, whisper_chunks: list, video_frames: np.ndarray):
+    def loop_video(self, whisper_chunks: torch.Tensor, video_frames: np.ndarray):
         # If the audio is longer than the video, we need to loop the video
         if len(whisper_chunks) > len(video_frames):
             faces, boxes, affine_matrices = self.affine_transform_video(video_frames)
@@ -311,6 +357,225 @@ class LipsyncPipeline(DiffusionPipeline):
 
         return video_frames, faces, boxes, affine_matrices
 
+    def denoise_window(
+        self,
+        faces: torch.Tensor,
+        audio_embeds: Optional[torch.Tensor],
+        latents: torch.Tensor,
+        timesteps: torch.Tensor,
+        height: int,
+        width: int,
+        guidance_scale: float,
+        weight_dtype: torch.dtype,
+        device: torch.device,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]],
+        extra_step_kwargs: dict,
+        callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
+        callback_steps: Optional[int] = 1,
+        masked_image_latent_params: Optional[torch.Tensor] = None,
+        ref_latent_params: Optional[torch.Tensor] = None,
+        num_windows: int = 1,
+    ):
+        """
+        `faces` may hold `num_windows` windows of the same length one after another, they are denoised as one batch.
+        The audio embeddings and the latents must be laid out the same way, the latents with one window per batch.
+        """
+        do_classifier_free_guidance = guidance_scale > 1.0
+        num_inference_steps = len(timesteps)
+
+        ref_pixel_values, masked_pixel_values, masks = self.image_processor.prepare_masks_and_masked_images(
+            faces, affine_transform=False
+        )
+
+        # The latents are sampled window by window, so the generator is consumed in the same order as when the
+        # windows are denoised one at a time
+        window_length = len(faces) // num_windows
+        mask_latents = []
+        masked_image_latents = []
+        ref_latents = []
+        for i in range(num_windows):
+            window = slice(i * window_length, (i + 1) * window_length)
+
+            # 7. Prepare mask latent variables
+            window_mask_latents, window_masked_image_latents = self.prepare_mask_latents(
+                masks[window],
+                masked_pixel_values[window],
+                height,
+                width,
+                weight_dtype,
+                device,
+                generator,
+                False,
+                None if masked_image_latent_params is None else masked_image_latent_params[window],
+            )
+            mask_latents.append(window_mask_latents)
+            masked_image_latents.append(window_masked_image_latents)
+
+            # 8. Prepare image latents
+            ref_latents.append(
+                self.prepare_image_latents(
+                    ref_pixel_values[window],
+                    device,
+                    weight_dtype,
+                    generator,
+                    False,
+                    None if ref_latent_params is None else ref_latent_params[window],
+                )
+            )
+
+        mask_latents = torch.cat(mask_latents)
+        masked_image_latents = torch.cat(masked_image_latents)
+        ref_latents = torch.cat(ref_latents)
+        if do_classifier_free_guidance:
+            mask_latents = torch.cat([mask_latents] * 2)
+            masked_image_latents = torch.cat([masked_image_latents] * 2)
+            ref_latents = torch.cat([ref_latents] * 2)
+
+        # 9. Denoising loop
+        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
+        # The audio embeddings of the window are the same at every denoising step
+        cross_attention_cache = CrossAttentionCache()
+        with self.progress_bar(total=num_inference_steps) as progress_bar:
+            for j, t in enumerate(timesteps):
+                # expand the latents if we are doing classifier free guidance
+                denoising_unet_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+
+                denoising_unet_input = self.scheduler.scale_model_input(denoising_unet_input, t)
+
+                # concat latents, mask, masked_image_latents in the channel dimension
+                denoising_unet_input = torch.cat(
+                    [denoising_unet_input, mask_latents, masked_image_latents, ref_latents], dim=1
+                )
+
+                # predict the noise residual
+                with use_cross_attention_cache(cross_attention_cache, audio_embeds):
+                    noise_pred = self.denoising_unet(
+                        denoising_unet_input, t, encoder_hidden_states=audio_embeds
+                    ).sample
+
+                # perform guidance
+                if do_classifier_free_guidance:
+                    noise_pred_uncond, noise_pred_audio = noise_pred.chunk(2)
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_audio - noise_pred_uncond)
+
+                # compute the previous noisy sample x_t -> x_t-1
+                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+
+                # call the callback, if provided
+                if j == len(timesteps) - 1 or ((j + 1) > num_warmup_steps and (j + 1) % self.scheduler.order == 0):
+                    progress_bar.update()
+                    if callback is not None and j % callback_steps == 0:
+                        callback(j, t, latents)
+
+        # Recover the pixel values
+        decoded_latents = self.decode_latents(latents)
+        decoded_latents = self.paste_surrounding_pixels_back(
+            decoded_latents, ref_pixel_values, 1 - masks, device, weight_dtype
+        )
+        return decoded_latents
+
+    def prepare_audio_embeds(self, whisper_chunks, device, weight_dtype, do_classifier_free_guidance):
+        if not self.denoising_unet.add_audio_layer:
+            return None
+        audio_embeds = whisper_chunks.to(device, dtype=weight_dtype)
+        if do_classifier_free_guidance:
+            null_audio_embeds = torch.zeros_like(audio_embeds)
+            audio_embeds = torch.cat([null_audio_embeds, audio_embeds])
+        return audio_embeds
+
+    def read_video_windows(self, video_reader: VideoFrameReader, num_output_frames: int, num_frames: int):
+        for start in range(0, num_output_frames, num_frames):
+            end = min(start + num_frames, num_output_frames)
+            frame_indices = loop_video_indices(start, end, len(video_reader))
+            yield dict(
+                start=start, end=end, frame_indices=frame_indices, video_frames=video_reader.get_frames(frame_indices)
+            )
+
+    def align_window(self, window: dict):
+        faces, boxes, affine_matrices = self.affine_transform_video(window["video_frames"], verbose=False)
+        window.update(faces=faces, boxes=boxes, affine_matrices=affine_matrices)
+        return window
+
+    def prepare_avatar(self, get_video_frames: Callable, num_video_frames: int, num_frames: int, device, weight_dtype):
+        faces = []
+        boxes = []
+        affine_matrices = []
+        masked_image_latent_params = []
+        ref_latent_params = []
+        print(f"Preparing the avatar of {num_video_frames} frames...")
+        for start in tqdm.tqdm(range(0, num_video_frames, num_frames)):
+            video_frames = get_video_frames(np.arange(start, min(start + num_frames, num_video_frames)))
+            window_faces, window_boxes, window_affine_matrices = self.affine_transform_video(
+                video_frames, verbose=False
+            )
+            ref_pixel_values, masked_pixel_values, _ = self.image_processor.prepare_masks_and_masked_images(
+                window_faces, affine_transform=False
+            )
+            masked_image_latent_params.append(
+                self.encode_latent_dist(masked_pixel_values, device, weight_dtype).parameters.cpu()
+            )
+            ref_latent_params.append(self.encode_latent_dist(ref_pixel_values, device, weight_dtype).parameters.cpu())
+            faces.append(window_faces)
+            boxes += window_boxes
+            affine_matrices += [affine_matrix.cpu() for affine_matrix in window_affine_matrices]
+
+        return dict(
+            faces=torch.cat(faces),
+            boxes=boxes,
+            affine_matrices=torch.stack(affine_matrices),
+            masked_image_latent_params=torch.cat(masked_image_latent_params),
+            ref_latent_params=torch.cat(ref_latent_params),
+        )
+
+    def get_avatar(
+        self,
+        video_path: str,
+        get_video_frames: Callable,
+        num_video_frames: int,
+        num_frames: int,
+        video_fps: int,
+        device,
+        weight_dtype,
+    ):
+        key = self.avatar_cache.get_key(
+            video_path, self.image_processor.resolution, self.image_processor.mask_image, video_fps
+        )
+        avatar = self.avatar_cache.load(key)
+        if avatar is None:
+            avatar = self.prepare_avatar(get_video_frames, num_video_frames, num_frames, device, weight_dtype)
+            self.avatar_cache.save(key, avatar)
+        else:
+            print(f"Loaded the avatar of {len(avatar['faces'])} frames from cache")
+        avatar["affine_matrices"] = avatar["affine_matrices"].to(self.image_processor.restorer.device)
+        return avatar
+
+    @staticmethod
+    def select_avatar_frames(avatar: dict, frame_indices: np.ndarray):
+        tensor_indices = torch.from_numpy(frame_indices)
+        return dict(
+            faces=avatar["faces"][tensor_indices],
+            boxes=[avatar["boxes"][index] for index in frame_indices],
+            affine_matrices=list(avatar["affine_matrices"][tensor_indices.to(avatar["affine_matrices"].device)]),
+            masked_image_latent_params=avatar["masked_image_latent_params"][tensor_indices],
+            ref_latent_params=avatar["ref_latent_params"][tensor_indices],
+        )
+
+    def restore_window(self, window: dict):
+        window["video_frames"] = self.restore_video(
+            window.pop("synced_faces"),
+            window["video_frames"],
+            window["boxes"],
+            window["affine_matrices"],
+            verbose=False,
+        )
+        return window
+
+    def write_output_video(self, synced_video_frames, audio_samples, video_out_path, video_fps, audio_sample_rate):
+        # `synced_video_frames` can be a generator of frame windows, which are encoded as soon as they are ready
+        with FFmpegVideoWriter(video_out_path, video_fps, audio_samples, audio_sample_rate) as writer:
+            for video_frames in synced_video_frames:
+                writer.write_frames(video_frames)
+
     @torch.no_grad()
     def __call__(
         self,
@@ -331,156 +596,231 @@ class LipsyncPipeline(DiffusionPipeline):
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[int] = 1,
+        streaming: bool = False,
+        stage_queue_size: int = 2,
+        window_batch_size: int = 1,
         **kwargs,
     ):
+        """
+        If `streaming` is True, the video is decoded, aligned, denoised, restored and encoded one window of
+        `num_frames` frames at a time, so the peak memory does not grow with the length of the video. The stages
+        run concurrently on consecutive windows, at most `stage_queue_size` windows wait between two stages.
+
+        `window_batch_size` windows are denoised together as one batch, which keeps the GPU busy at low
+        resolutions. The output is the same as denoising the windows one by one: a trailing short window is denoised
+        on its own at its length rather than padded, and with `eta` > 0 the windows are denoised one by one.
+
+        No intermediate file is written, so several calls can run concurrently in one process. Concurrent calls
+        need their own pipeline instance, which can share the models with the others.
+        """
         is_train = self.denoising_unet.training
         self.denoising_unet.eval()
-
-        check_ffmpeg_installed()
-
-        # 0. Define call parameters
-        batch_size = 1
-        device = self._execution_device
-        mask_image = load_fixed_mask(height, mask_image_path)
-        self.image_processor = ImageProcessor(height, device="cuda", mask_image=mask_image)
-        self.set_progress_bar_config(desc=f"Sample frames: {num_frames}")
-
-        # 1. Default height and width to unet
-        height = height or self.denoising_unet.config.sample_size * self.vae_scale_factor
-        width = width or self.denoising_unet.config.sample_size * self.vae_scale_factor
-
-        # 2. Check inputs
-        self.check_inputs(height, width, callback_steps)
-
-        # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
-        # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
-        # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = guidance_scale > 1.0
-
-        # 3. set timesteps
-        self.scheduler.set_timesteps(num_inference_steps, device=device)
-        timesteps = self.scheduler.timesteps
-
-        # 4. Prepare extra step kwargs.
-        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
-
-        whisper_feature = self.audio_encoder.audio2feat(audio_path)
-        whisper_chunks = self.audio_encoder.feature2chunks(feature_array=whisper_feature, fps=video_fps)
-
-        audio_samples = read_audio(audio_path)
-        video_frames = read_video(video_path, use_decord=False)
-
-        video_frames, faces, boxes, affine_matrices = self.loop_video(whisper_chunks, video_frames)
-
-        synced_video_frames = []
-
-        num_channels_latents = self.vae.config.latent_channels
-
-        # Prepare latent variables
-        all_latents = self.prepare_latents(
-            batch_size,
-            len(whisper_chunks),
-            num_channels_latents,
-            height,
-            width,
-            weight_dtype,
-            device,
-            generator,
-        )
-
-        num_inferences = math.ceil(len(whisper_chunks) / num_frames)
-        for i in tqdm.tqdm(range(num_inferences), desc="Doing inference..."):
-            if self.denoising_unet.add_audio_layer:
-                audio_embeds = torch.stack(whisper_chunks[i * num_frames : (i + 1) * num_frames])
-                audio_embeds = audio_embeds.to(device, dtype=weight_dtype)
-                if do_classifier_free_guidance:
-                    null_audio_embeds = torch.zeros_like(audio_embeds)
-                    audio_embeds = torch.cat([null_audio_embeds, audio_embeds])
-            else:
-                audio_embeds = None
-            inference_faces = faces[i * num_frames : (i + 1) * num_frames]
-            latents = all_latents[:, :, i * num_frames : (i + 1) * num_frames]
-            ref_pixel_values, masked_pixel_values, masks = self.image_processor.prepare_masks_and_masked_images(
-                inference_faces, affine_transform=False
-            )
-
-            # 7. Prepare mask latent variables
-            mask_latents, masked_image_latents = self.prepare_mask_latents(
-                masks,
-                masked_pixel_values,
+        video_reader = None
+
+        try:
+            check_ffmpeg_installed()
+
+            # 0. Define call parameters
+            batch_size = 1
+            device = self._execution_device
+            mask_image = load_fixed_mask(height, mask_image_path)
+            self.image_processor = ImageProcessor(height, device="cuda", mask_image=mask_image)
+            self.set_progress_bar_config(desc=f"Sample frames: {num_frames}")
+
+            # 1. Default height and width to unet
+            height = height or self.denoising_unet.config.sample_size * self.vae_scale_factor
+            width = width or self.denoising_unet.config.sample_size * self.vae_scale_factor
+
+            # 2. Check inputs
+            self.check_inputs(height, width, callback_steps)
+
+            # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
+            # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
+            # corresponds to doing no classifier free guidance.
+            do_classifier_free_guidance = guidance_scale > 1.0
+
+            # 3. set timesteps
+            self.scheduler.set_timesteps(num_inference_steps, device=device)
+            timesteps = self.scheduler.timesteps
+
+            # 4. Prepare extra step kwargs.
+            extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+
+            if window_batch_size > 1 and extra_step_kwargs.get("eta", 0.0) > 0:
+                # The scheduler noise of a batch is drawn for all its windows at every step, which consumes the
+                # generator in another order than denoising the windows one by one
+                logger.warning("window_batch_size is ignored when eta > 0, the windows are denoised one by one")
+                window_batch_size = 1
+
+            # The audio is decoded once, for both the whisper features and the output video
+            audio_samples = read_audio(audio_path)
+            whisper_feature = self.audio_encoder.audio2feat(audio_path, audio_samples=audio_samples)
+            num_output_frames = self.audio_encoder.get_num_chunks(len(whisper_feature), video_fps)
+            if not streaming:
+                whisper_chunks = self.audio_encoder.feature2chunks(feature_array=whisper_feature, fps=video_fps)
+
+            num_channels_latents = self.vae.config.latent_channels
+
+            # Prepare latent variables, the same initial noise is shared by all the frames
+            window_latents = self.prepare_latents(
+                batch_size,
+                num_frames,
+                num_channels_latents,
                 height,
                 width,
                 weight_dtype,
                 device,
                 generator,
-                do_classifier_free_guidance,
-            )
-
-            # 8. Prepare image latents
-            ref_latents = self.prepare_image_latents(
-                ref_pixel_values,
-                device,
-                weight_dtype,
-                generator,
-                do_classifier_free_guidance,
             )
 
-            # 9. Denoising loop
-            num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-            with self.progress_bar(total=num_inference_steps) as progress_bar:
-                for j, t in enumerate(timesteps):
-                    # expand the latents if we are doing classifier free guidance
-                    denoising_unet_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-
-                    denoising_unet_input = self.scheduler.scale_model_input(denoising_unet_input, t)
-
-                    # concat latents, mask, masked_image_latents in the channel dimension
-                    denoising_unet_input = torch.cat(
-                        [denoising_unet_input, mask_latents, masked_image_latents, ref_latents], dim=1
+            def denoise(inference_faces, inference_chunks, masked_image_latent_params=None, ref_latent_params=None):
+                # The full windows are denoised as one batch. A trailing short window is denoised on its own, because
+                # padding it in time would change what the temporal layers attend to, and so the output
+                num_full_windows = len(inference_faces) // num_frames
+                batches = []
+                if num_full_windows > 0:
+                    batches.append((0, num_full_windows * num_frames, num_full_windows))
+                if len(inference_faces) % num_frames != 0:
+                    batches.append((num_full_windows * num_frames, len(inference_faces), 1))
+
+                synced_faces = []
+                for start, end, num_windows in batches:
+                    audio_embeds = self.prepare_audio_embeds(
+                        inference_chunks[start:end], device, weight_dtype, do_classifier_free_guidance
+                    )
+                    synced_faces.append(
+                        self.denoise_window(
+                            inference_faces[start:end],
+                            audio_embeds,
+                            window_latents[:, :, : (end - start) // num_windows].repeat(num_windows, 1, 1, 1, 1),
+                            timesteps,
+                            height,
+                            width,
+                            guidance_scale,
+                            weight_dtype,
+                            device,
+                            generator,
+                            extra_step_kwargs,
+                            callback,
+                            callback_steps,
+                            None if masked_image_latent_params is None else masked_image_latent_params[start:end],
+                            None if ref_latent_params is None else ref_latent_params[start:end],
+                            num_windows,
+                        )
+                    )
+                return torch.cat(synced_faces)
+
+            if streaming:
+                video_reader = VideoFrameReader(video_path, fps=video_fps)
+
+                def denoise_stream_window(window: dict):
+                    window["synced_faces"] = denoise(
+                        window.pop("faces"),
+                        # Only the chunks of the window, the chunks of the whole audio would grow with its length
+                        self.audio_encoder.get_sliced_features(
+                            whisper_feature, torch.arange(window["start"], window["end"]), fps=video_fps
+                        ),
+                        window.pop("masked_image_latent_params", None),
+                        window.pop("ref_latent_params", None),
+                    )
+                    return window
+
+                if self.avatar_cache is not None:
+                    # On a cache hit the face detection, alignment and VAE encoding are skipped
+                    avatar = self.get_avatar(
+                        video_path,
+                        video_reader.get_frames,
+                        len(video_reader),
+                        num_frames,
+                        video_fps,
+                        device,
+                        weight_dtype,
                     )
 
-                    # predict the noise residual
-                    noise_pred = self.denoising_unet(
-                        denoising_unet_input, t, encoder_hidden_states=audio_embeds
-                    ).sample
-
-                    # perform guidance
-                    if do_classifier_free_guidance:
-                        noise_pred_uncond, noise_pred_audio = noise_pred.chunk(2)
-                        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_audio - noise_pred_uncond)
-
-                    # compute the previous noisy sample x_t -> x_t-1
-                    latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-
-                    # call the callback, if provided
-                    if j == len(timesteps) - 1 or ((j + 1) > num_warmup_steps and (j + 1) % self.scheduler.order == 0):
-                        progress_bar.update()
-                        if callback is not None and j % callback_steps == 0:
-                            callback(j, t, latents)
-
-            # Recover the pixel values
-            decoded_latents = self.decode_latents(latents)
-            decoded_latents = self.paste_surrounding_pixels_back(
-                decoded_latents, ref_pixel_values, 1 - masks, device, weight_dtype
-            )
-            synced_video_frames.append(decoded_latents)
-
-        synced_video_frames = self.restore_video(torch.cat(synced_video_frames), video_frames, boxes, affine_matrices)
-
-        audio_samples_remain_length = int(synced_video_frames.shape[0] / video_fps * audio_sample_rate)
-        audio_samples = audio_samples[:audio_samples_remain_length].cpu().numpy()
+                    def prepare_stream_window(window: dict):
+                        window.update(self.select_avatar_frames(avatar, window["frame_indices"]))
+                        return window
 
-        if is_train:
-            self.denoising_unet.train()
+                else:
+                    prepare_stream_window = self.align_window
+
+                # The stages run in their own threads, so the CPU-heavy alignment and restoring of the neighbouring
+                # windows overlap with the denoising of the current window
+                stage_executor = StageExecutor(
+                    [
+                        ("align", torch.no_grad()(prepare_stream_window)),
+                        ("denoise", torch.no_grad()(denoise_stream_window)),
+                        ("restore", torch.no_grad()(self.restore_window)),
+                    ],
+                    queue_size=stage_queue_size,
+                    source_name="decode",
+                    sink_name="encode",
+                )
+                windows = stage_executor.run(
+                    self.read_video_windows(video_reader, num_output_frames, num_frames * window_batch_size)
+                )
+                synced_video_frames = (
+                    window["video_frames"]
+                    for window in tqdm.tqdm(
+                        windows,
+                        total=math.ceil(num_output_frames / (num_frames * window_batch_size)),
+                        desc="Doing inference...",
+                    )
+                )
+            else:
+                video_frames = read_video(video_path, use_decord=False, fps=video_fps)
+
+                if self.avatar_cache is not None:
+                    avatar = self.get_avatar(
+                        video_path,
+                        lambda frame_indices: video_frames[frame_indices],
+                        len(video_frames),
+                        num_frames,
+                        video_fps,
+                        device,
+                        weight_dtype,
+                    )
+                    frame_indices = loop_video_indices(0, num_output_frames, len(video_frames))
+                    video_frames = video_frames[frame_indices]
+                    avatar_frames = self.select_avatar_frames(avatar, frame_indices)
+                    faces = avatar_frames["faces"]
+                    boxes = avatar_frames["boxes"]
+                    affine_matrices = avatar_frames["affine_matrices"]
+                    masked_image_latent_params = avatar_frames["masked_image_latent_params"]
+                    ref_latent_params = avatar_frames["ref_latent_params"]
+                else:
+                    video_frames, faces, boxes, affine_matrices = self.loop_video(whisper_chunks, video_frames)
+                    masked_image_latent_params = None
+                    ref_latent_params = None
+
+                synced_faces = []
+                inference_length = num_frames * window_batch_size
+                num_inferences = math.ceil(num_output_frames / inference_length)
+                for i in tqdm.tqdm(range(num_inferences), desc="Doing inference..."):
+                    window = slice(i * inference_length, (i + 1) * inference_length)
+                    synced_faces.append(
+                        denoise(
+                            faces[window],
+                            whisper_chunks[window],
+                            None if masked_image_latent_params is None else masked_image_latent_params[window],
+                            None if ref_latent_params is None else ref_latent_params[window],
+                        )
+                    )
 
-        temp_dir = "temp"
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        os.makedirs(temp_dir, exist_ok=True)
+                synced_video_frames = [
+                    self.restore_video(torch.cat(synced_faces), video_frames, boxes, affine_matrices)
+                ]
 
-        write_video(os.path.join(temp_dir, "video.mp4"), synced_video_frames, fps=25)
+            audio_samples_remain_length = int(num_output_frames / video_fps * audio_sample_rate)
+            audio_samples = audio_samples[:audio_samples_remain_length].cpu().numpy()
 
-        sf.write(os.path.join(temp_dir, "audio.wav"), audio_samples, audio_sample_rate)
+            self.write_output_video(synced_video_frames, audio_samples, video_out_path, video_fps, audio_sample_rate)
 
-        command = f"ffmpeg -y -loglevel error -nostdin -i {os.path.join(temp_dir, 'video.mp4')} -i {os.path.join(temp_dir, 'audio.wav')} -c:v libx264 -crf 18 -c:a aac -q:v 0 -q:a 0 {video_out_path}"
-        subprocess.run(command, shell=True)
+            if streaming:
+                print(f"Stage timings:\n{stage_executor.summary()}")
+        finally:
+            # Also when a stage fails, e.g. during a validation run of the training
+            if video_reader is not None:
+                video_reader.close()
+            if is_train:
+                self.denoising_unet.train()
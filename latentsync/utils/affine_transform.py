@@ -1,8 +1,8 @@
 # Adapted from https://github.com/guanjz20/StyleSync/blob/main/utils.py
 
 import numpy as np
-import cv2
 import torch
+import torch.nn.functional as F
 from einops import rearrange
 import kornia
 
@@ -42,58 +42,113 @@ class AlignRestore(object):
         return cropped_face, affine_matrix
 
     def restore_img(self, input_img, face, affine_matrix):
-        h, w, _ = input_img.shape
-
-        if isinstance(affine_matrix, np.ndarray):
-            affine_matrix = torch.from_numpy(affine_matrix).to(device=self.device, dtype=self.dtype).unsqueeze(0)
-
-        inv_affine_matrix = kornia.geometry.transform.invert_affine_transform(affine_matrix)
-        face = face.to(dtype=self.dtype).unsqueeze(0)
-
-        inv_face = kornia.geometry.transform.warp_affine(
-            face, inv_affine_matrix, (h, w), mode="bilinear", padding_mode="fill", fill_value=self.fill_value
-        ).squeeze(0)
-        inv_face = (inv_face / 2 + 0.5).clamp(0, 1) * 255
+        return self.restore_batch(input_img[None].copy(), face.unsqueeze(0), [affine_matrix])[0]
+
+    def get_restore_rois(self, inv_affine_matrices: torch.Tensor, h: int, w: int):
+        """
+        Top left corners of the regions of the frames that the faces are pasted into, padded so that the erosion
+        and the blur of the mask give the same result as on the full frame. The regions of a batch share one size,
+        returned as (roi_h, roi_w), so that they can be warped together.
+        """
+        face_w, face_h = self.face_size
+        inv_affine_matrices = inv_affine_matrices.float()
+        corners = torch.tensor(
+            [[0, 0, 1], [face_w, 0, 1], [0, face_h, 1], [face_w, face_h, 1]],
+            device=inv_affine_matrices.device,
+            dtype=torch.float32,
+        )
+        points = torch.einsum("nij,kj->nki", inv_affine_matrices, corners)  # (n, 4, 2)
+
+        # The face area and so the edge width estimated from the scale of the inverse affine transform
+        scales = (
+            inv_affine_matrices[:, 0, 0] * inv_affine_matrices[:, 1, 1]
+            - inv_affine_matrices[:, 0, 1] * inv_affine_matrices[:, 1, 0]
+        ).abs()
+        w_edges = (scales * face_w * face_h).sqrt().floor() // 20
+        margins = 3 * w_edges + 8
+
+        x0 = (points[..., 0].amin(dim=1) - margins).floor().clamp(0, w)
+        y0 = (points[..., 1].amin(dim=1) - margins).floor().clamp(0, h)
+        x1 = (points[..., 0].amax(dim=1) + margins).ceil().clamp(0, w)
+        y1 = (points[..., 1].amax(dim=1) + margins).ceil().clamp(0, h)
+        rois = torch.stack([x0, y0, x1, y1], dim=1).long().tolist()
+
+        roi_w = max(max(x1 - x0 for x0, _, x1, _ in rois), 1)
+        roi_h = max(max(y1 - y0 for _, y0, _, y1 in rois), 1)
+        offsets = [(min(x0, w - roi_w), min(y0, h - roi_h)) for x0, y0, _, _ in rois]
+        return offsets, (roi_h, roi_w)
+
+    def restore_batch(self, input_imgs: np.ndarray, faces: torch.Tensor, affine_matrices):
+        """
+        Batched `restore_img`: paste N faces back into N frames of the same size. Only the region around each face
+        is warped, eroded, blurred and blended, and pasted back into `input_imgs` in place, so the cost scales with
+        the face size rather than the frame size. Frames are grouped by blur kernel size, so a window costs a few
+        kernel launches. Returns `input_imgs`, a uint8 array of shape (N, H, W, C).
+        """
+        n, h, w, _ = input_imgs.shape
+
+        affine_matrices = torch.stack([torch.as_tensor(matrix).reshape(2, 3) for matrix in affine_matrices])
+        affine_matrices = affine_matrices.to(device=self.device, dtype=self.dtype)
+        inv_affine_matrices = kornia.geometry.transform.invert_affine_transform(affine_matrices)
+        faces = faces.to(device=self.device, dtype=self.dtype)
+
+        offsets, roi_size = self.get_restore_rois(inv_affine_matrices, h, w)
+        roi_h, roi_w = roi_size
+        # Map the faces to the regions instead of the full frames
+        roi_inv_affine_matrices = inv_affine_matrices.float()
+        roi_inv_affine_matrices[:, :, 2] -= torch.tensor(offsets, device=self.device, dtype=torch.float32)
+        roi_inv_affine_matrices = roi_inv_affine_matrices.to(dtype=self.dtype)
+
+        inv_faces = kornia.geometry.transform.warp_affine(
+            faces, roi_inv_affine_matrices, roi_size, mode="bilinear", padding_mode="fill", fill_value=self.fill_value
+        )
+        inv_faces = (inv_faces / 2 + 0.5).clamp(0, 1) * 255
 
-        input_img = rearrange(torch.from_numpy(input_img).to(device=self.device, dtype=self.dtype), "h w c -> c h w")
-        inv_mask = kornia.geometry.transform.warp_affine(
-            self.mask, inv_affine_matrix, (h, w), padding_mode="zeros"
-        )  # (1, 1, h_up, w_up)
+        rois = np.stack([input_imgs[i, y0 : y0 + roi_h, x0 : x0 + roi_w] for i, (x0, y0) in enumerate(offsets)])
+        rois = rearrange(torch.from_numpy(rois).to(device=self.device, dtype=self.dtype), "b h w c -> b c h w")
+        inv_masks = kornia.geometry.transform.warp_affine(
+            self.mask.expand(n, -1, -1, -1), roi_inv_affine_matrices, roi_size, padding_mode="zeros"
+        )  # (n, 1, roi_h, roi_w)
 
-        inv_mask_erosion = kornia.morphology.erosion(
-            inv_mask,
+        inv_masks_erosion = kornia.morphology.erosion(
+            inv_masks,
             torch.ones(
                 (int(2 * self.upscale_factor), int(2 * self.upscale_factor)), device=self.device, dtype=self.dtype
             ),
         )
-
-        inv_mask_erosion_t = inv_mask_erosion.squeeze(0).expand_as(inv_face)
-        pasted_face = inv_mask_erosion_t * inv_face
-        total_face_area = torch.sum(inv_mask_erosion.float())
-        w_edge = int(total_face_area**0.5) // 20
+        pasted_faces = inv_masks_erosion * inv_faces
+
+        total_face_areas = torch.sum(inv_masks_erosion.float(), dim=(1, 2, 3))
+        w_edges = (total_face_areas**0.5).long().div(20, rounding_mode="floor").tolist()
+
+        inv_soft_masks = torch.empty_like(inv_masks_erosion)
+        for w_edge in set(w_edges):
+            indices = [i for i, frame_w_edge in enumerate(w_edges) if frame_w_edge == w_edge]
+            inv_soft_masks[indices] = self.soften_mask(inv_masks_erosion[indices], w_edge)
+
+        rois_back = inv_soft_masks * pasted_faces + (1 - inv_soft_masks) * rois
+        rois_back = rearrange(rois_back, "b c h w -> b h w c").contiguous().to(dtype=torch.uint8).cpu().numpy()
+        for i, (x0, y0) in enumerate(offsets):
+            input_imgs[i, y0 : y0 + roi_h, x0 : x0 + roi_w] = rois_back[i]
+        return input_imgs
+
+    @staticmethod
+    def erode(masks: torch.Tensor, kernel_size: int):
+        # Same as cv2.erode with a square kernel and the default anchor and border. Unlike
+        # kornia.morphology.erosion, max pooling does not unfold the kernel, so large kernels take little memory
+        pad_before = kernel_size // 2
+        pad_after = kernel_size - 1 - pad_before
+        inv_masks = F.pad(1 - masks, (pad_before, pad_after, pad_before, pad_after), value=0)
+        return 1 - F.max_pool2d(inv_masks, kernel_size, stride=1)
+
+    def soften_mask(self, inv_masks_erosion: torch.Tensor, w_edge: int):
         erosion_radius = w_edge * 2
-
-        # This step will consume a large amount of GPU memory.
-        # inv_mask_center = kornia.morphology.erosion(
-        #     inv_mask_erosion, torch.ones((erosion_radius, erosion_radius), device=self.device, dtype=self.dtype)
-        # )
-
-        # Run on CPU to avoid consuming a large amount of GPU memory.
-        inv_mask_erosion = inv_mask_erosion.squeeze().cpu().numpy().astype(np.float32)
-        inv_mask_center = cv2.erode(inv_mask_erosion, np.ones((erosion_radius, erosion_radius), np.uint8))
-        inv_mask_center = torch.from_numpy(inv_mask_center).to(device=self.device, dtype=self.dtype)[None, None, ...]
+        # cv2.erode falls back to a 3x3 kernel when the kernel is empty
+        inv_masks_center = self.erode(inv_masks_erosion, erosion_radius if erosion_radius > 0 else 3)
 
         blur_size = w_edge * 2 + 1
         sigma = 0.3 * ((blur_size - 1) * 0.5 - 1) + 0.8
-        inv_soft_mask = kornia.filters.gaussian_blur2d(
-            inv_mask_center, (blur_size, blur_size), (sigma, sigma)
-        ).squeeze(0)
-        inv_soft_mask_3d = inv_soft_mask.expand_as(inv_face)
-        img_back = inv_soft_mask_3d * pasted_face + (1 - inv_soft_mask_3d) * input_img
-
-        img_back = rearrange(img_back, "c h w -> h w c").contiguous().to(dtype=torch.uint8)
-        img_back = img_back.cpu().numpy()
-        return img_back
+        return kornia.filters.gaussian_blur2d(inv_masks_center, (blur_size, blur_size), (sigma, sigma))
 
     def transformation_from_points(self, points1: torch.Tensor, points0: torch.Tensor, smooth=True, p_bias=None):
         if isinstance(points0, np.ndarray):
@@ -65,6 +65,92 @@ def melspectrogram(wav):
     return S
 
 
+def melspectrogram_torch(wavs: torch.Tensor, lengths: torch.Tensor = None):
+    """
+    Batched torch version of `melspectrogram`, on the device and in the floating point dtype of `wavs`.
+    :param wavs: (n_samples,) or (batch, n_samples), zero-padded on the right when of different lengths
+    :param lengths: (batch,) the number of samples of every waveform, all of them by default
+    :return: (80, n_frames) or (batch, 80, n_frames), the frames of a waveform past `lengths // hop_size + 1` are
+        padding
+    """
+    if config.audio.use_lws:
+        raise NotImplementedError("The torch melspectrogram does not support lws")
+
+    is_batched = wavs.ndim == 2
+    if not is_batched:
+        wavs = wavs.unsqueeze(0)
+    if not wavs.is_floating_point():
+        wavs = wavs.float()
+
+    wavs = _preemphasis_torch(wavs, config.audio.preemphasis, config.audio.preemphasize)
+    if lengths is not None:
+        # librosa pads the preemphasized waveform with zeros, the preemphasis of the padding is not zero
+        positions = torch.arange(wavs.shape[-1], device=wavs.device)
+        wavs = wavs * (positions < lengths.to(wavs.device)[:, None])
+
+    D = _stft_torch(wavs)
+    S = _amp_to_db_torch(_linear_to_mel_torch(D.abs())) - config.audio.ref_level_db
+    if config.audio.signal_normalization:
+        S = _normalize_torch(S)
+
+    return S if is_batched else S.squeeze(0)
+
+
+def _preemphasis_torch(wavs, k, preemphasize=True):
+    # Same as lfilter([1, -k], [1], wav) along the last dimension
+    if not preemphasize:
+        return wavs
+    output = wavs.clone()
+    output[..., 1:] -= k * wavs[..., :-1]
+    return output
+
+
+def _stft_torch(wavs):
+    # The defaults of librosa.stft: centered frames, zero padding and a periodic Hann window
+    window = torch.hann_window(config.audio.win_size, periodic=True, device=wavs.device, dtype=wavs.dtype)
+    return torch.stft(
+        wavs,
+        n_fft=config.audio.n_fft,
+        hop_length=get_hop_size(),
+        win_length=config.audio.win_size,
+        window=window,
+        center=True,
+        pad_mode="constant",
+        return_complex=True,
+    )
+
+
+_mel_basis_torch = {}
+
+
+def _linear_to_mel_torch(spectrogram):
+    key = (spectrogram.device, spectrogram.dtype)
+    if key not in _mel_basis_torch:
+        _mel_basis_torch[key] = torch.from_numpy(_build_mel_basis()).to(spectrogram.device, spectrogram.dtype)
+    return _mel_basis_torch[key] @ spectrogram
+
+
+def _amp_to_db_torch(x):
+    min_level = np.exp(config.audio.min_level_db / 20 * np.log(10))
+    return 20 * torch.log10(torch.clamp(x, min=min_level))
+
+
+def _normalize_torch(S):
+    # Same as `_normalize`
+    max_abs_value = config.audio.max_abs_value
+    min_level_db = config.audio.min_level_db
+    if config.audio.symmetric_mels:
+        S = (2 * max_abs_value) * ((S - min_level_db) / (-min_level_db)) - max_abs_value
+        min_value = -max_abs_value
+    else:
+        S = max_abs_value * ((S - min_level_db) / (-min_level_db))
+        min_value = 0
+
+    if config.audio.allow_clipping_in_normalization:
+        return torch.clamp(S, min_value, max_abs_value)
+    return S
+
+
 def _lws_processor():
     import lws
 
@@ -0,0 +1,51 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+from .disk_cache import DiskCache, hash_file
+
+
+class AudioEmbedsCache(DiskCache):
+    """
+    Cache of the whisper embeddings of audio files, keyed by the content of the audio and the identity of the
+    model that encoded it. Two files with the same name never collide, the same audio under different names is
+    encoded once, and embeddings of another checkpoint or layer selection are never served, so inference and
+    training can share one cache directory.
+    """
+
+    def __init__(self, cache_dir: str, model_id: str, max_size_bytes: int = -1):
+        super().__init__(cache_dir, max_size_bytes, suffix="_embeds.pt")
+        self.model_id = model_id
+        # The training loop looks up the same files again and again, only hash a file again when it changed
+        self._content_hashes = {}
+        self._hashes_lock = threading.Lock()
+
+    def get_content_hash(self, audio_path: str) -> str:
+        stat = os.stat(audio_path)
+        file_id = (os.path.abspath(audio_path), stat.st_size, stat.st_mtime_ns)
+        with self._hashes_lock:
+            content_hash = self._content_hashes.get(file_id)
+        if content_hash is None:
+            content_hash = hash_file(audio_path)
+            with self._hashes_lock:
+                self._content_hashes[file_id] = content_hash
+        return content_hash
+
+    def get_key(self, audio_path: str, content_hash: str = None) -> str:
+        # A content hash computed beforehand, e.g. by `DatasetIndex`, saves reading the file
+        if content_hash is None:
+            content_hash = self.get_content_hash(audio_path)
+        return f"{content_hash}_{self.model_id}"
@@ -0,0 +1,36 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+
+import torch
+
+from .disk_cache import DiskCache, hash_file
+
+
+class AvatarCache(DiskCache):
+    """
+    Cache of the preprocessing results of an avatar video, which can be reused with any audio. An entry holds, for
+    every frame of the video (before looping), the face box, the affine matrix, the aligned face, and the latent
+    distribution parameters of the masked face and the reference face. Keeping the distributions instead of
+    samples means a cache hit draws exactly the same latents as a cache miss for the same generator.
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int = 20 * 1024**3):
+        super().__init__(cache_dir, max_size_bytes)
+
+    @staticmethod
+    def get_key(video_path: str, resolution: int, mask_image: torch.Tensor, video_fps: int) -> str:
+        mask_hash = hashlib.sha256(mask_image.float().numpy().tobytes()).hexdigest()[:16]
+        return f"{hash_file(video_path)}_{resolution}_{video_fps}fps_{mask_hash}"
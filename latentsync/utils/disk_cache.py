@@ -0,0 +1,106 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import hashlib
+import threading
+import uuid
+from pathlib import Path
+
+import torch
+
+
+def hash_file(file_path: str, chunk_size: int = 1 << 20) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DiskCache:
+    """
+    A directory of entries saved by `torch.save`. Entries are written atomically, so several processes can share
+    one cache directory. When the total size exceeds `max_size_bytes`, the least recently used entries are
+    evicted. The modification time of an entry is refreshed on every hit and is used as its last access time.
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int = -1, suffix: str = ".pt"):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def load(self, key: str, map_location="cpu"):
+        cache_path = self.get_path(key)
+        if not os.path.isfile(cache_path):
+            return None
+        try:
+            entry = torch.load(cache_path, map_location=map_location, weights_only=True)
+        except FileNotFoundError:  # evicted by another process
+            return None
+        except Exception as e:
+            print(f"{type(e).__name__} - {e} - {cache_path}")
+            self._remove(cache_path)
+            return None
+        try:
+            os.utime(cache_path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def save(self, key: str, entry):
+        cache_path = self.get_path(key)
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            torch.save(entry, temp_path)
+            os.replace(temp_path, cache_path)
+        finally:
+            self._remove(temp_path)
+        self.evict()
+
+    def evict(self):
+        if self.max_size_bytes < 0:
+            return
+        with self._lock:
+            entries = []
+            for file in os.listdir(self.cache_dir):
+                if not file.endswith(self.suffix):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, file))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, file in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                self._remove(os.path.join(self.cache_dir, file))
+                total_size -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -99,6 +99,33 @@ class ImageProcessor:
         pixel_values = self.normalize(images / 255.0)
         return pixel_values
 
+    def process_images_batch(self, images: torch.Tensor):
+        """
+        Batched `process_images` of uint8 frames on any device, e.g. the frames of a whole training batch on the GPU
+        after a uint8 transfer. The frames must all have the same size
+        """
+        if images.shape[3] == 3:
+            images = rearrange(images, "n h w c -> n c h w")
+        pixel_values = images.float()
+        if pixel_values.shape[-2:] != (self.resolution, self.resolution):
+            pixel_values = torch.nn.functional.interpolate(
+                pixel_values, size=(self.resolution, self.resolution), mode="bicubic", antialias=True
+            )
+            # `transforms.Resize` of uint8 frames gives uint8 frames
+            pixel_values = pixel_values.round_().clamp_(0, 255)
+        return self.normalize(pixel_values / 255.0)
+
+    def prepare_masks_and_masked_images_batch(self, images: torch.Tensor):
+        """
+        Batched `prepare_masks_and_masked_images` of uint8 frames without the affine transform, see
+        `process_images_batch`
+        """
+        pixel_values = self.process_images_batch(images)
+        mask_image = self.mask_image.to(pixel_values.device, dtype=pixel_values.dtype)
+        masked_pixel_values = pixel_values * mask_image
+        masks = mask_image[0:1].expand(len(pixel_values), -1, -1, -1)
+        return pixel_values, masked_pixel_values, masks
+
 
 class VideoProcessor:
     def __init__(self, resolution: int = 512, device: str = "cpu"):
@@ -0,0 +1,153 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List, Tuple
+
+_STOP = object()
+
+
+class StageExecutor:
+    """
+    Run a chain of stages in worker threads connected by bounded queues, so that the stages of consecutive
+    items overlap, e.g. the face alignment of window i+1 and the restoring of window i-1 run while window i is
+    being denoised. Each stage processes its items in order, and the outputs are yielded in the input order.
+
+    The busy time of every stage is recorded in `timings`. The producer of the input items and the consumer of
+    the outputs are timed as well, under `source_name` and `sink_name`.
+    """
+
+    def __init__(
+        self,
+        stages: List[Tuple[str, Callable]],
+        queue_size: int = 2,
+        source_name: str = "source",
+        sink_name: str = "sink",
+    ):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.source_name = source_name
+        self.sink_name = sink_name
+        self.timings = {}
+        self.wall_time = 0.0
+
+    def _put(self, q: queue.Queue, item, stop_event: threading.Event):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue, stop_event: threading.Event):
+        while not stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _run_source(self, items: Iterable, out_queue: queue.Queue, stop_event: threading.Event, errors: list):
+        try:
+            iterator = iter(items)
+            while True:
+                start_time = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.timings[self.source_name] += time.perf_counter() - start_time
+                if not self._put(out_queue, item, stop_event):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            self._put(out_queue, _STOP, stop_event)
+
+    def _run_stage(
+        self,
+        name: str,
+        fn: Callable,
+        in_queue: queue.Queue,
+        out_queue: queue.Queue,
+        stop_event: threading.Event,
+        errors: list,
+    ):
+        try:
+            while True:
+                item = self._get(in_queue, stop_event)
+                if item is _STOP:
+                    break
+                start_time = time.perf_counter()
+                item = fn(item)
+                self.timings[name] += time.perf_counter() - start_time
+                if not self._put(out_queue, item, stop_event):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            self._put(out_queue, _STOP, stop_event)
+
+    def run(self, items: Iterable):
+        self.timings = {self.source_name: 0.0}
+        self.timings.update({name: 0.0 for name, _ in self.stages})
+        self.timings[self.sink_name] = 0.0
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop_event = threading.Event()
+        errors = []
+
+        threads = [threading.Thread(target=self._run_source, args=(items, queues[0], stop_event, errors), daemon=True)]
+        for i, (name, fn) in enumerate(self.stages):
+            threads.append(
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(name, fn, queues[i], queues[i + 1], stop_event, errors),
+                    daemon=True,
+                )
+            )
+
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(queues[-1], stop_event)
+                if item is _STOP:
+                    break
+                sink_start_time = time.perf_counter()
+                yield item
+                self.timings[self.sink_name] += time.perf_counter() - sink_start_time
+        finally:
+            # Also reached when the consumer stops early, unblock and release the worker threads
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            self.wall_time = time.perf_counter() - start_time
+
+        if errors:
+            raise errors[0]
+
+    def summary(self) -> str:
+        busy_time = sum(self.timings.values())
+        lines = [f"{name}: {seconds:.2f}s" for name, seconds in self.timings.items()]
+        lines.append(f"total stage time: {busy_time:.2f}s, wall time: {self.wall_time:.2f}s")
+        lines.append(f"time hidden by overlapping: {max(busy_time - self.wall_time, 0.0):.2f}s")
+        return "\n".join(lines)
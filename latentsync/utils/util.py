@@ -28,9 +28,12 @@ from torchvision import transforms
 
 from einops import rearrange
 import cv2
-from decord import AudioReader, VideoReader
+from decord import VideoReader
 import shutil
 import subprocess
+import threading
+
+from ..whisper.whisper.audio import load_audio
 
 
 # Machine epsilon for a float32 (single precision)
@@ -43,34 +46,49 @@ def read_json(filepath: str):
     return json_dict
 
 
-def read_video(video_path: str, change_fps=True, use_decord=True):
+def get_resampled_frame_indices(video_reader: VideoReader, fps: int = 25):
+    """
+    Indices of the source frames shown at every tick of a constant `fps` clock. Frames are dropped or duplicated
+    according to their timestamps, like `ffmpeg -r` does. Returns None if the video already has the frame rate.
+    """
+    if abs(video_reader.get_avg_fps() - fps) < 1e-2:
+        return None
+    timestamps = video_reader.get_frame_timestamp(np.arange(len(video_reader)))  # (n, 2) start and end in seconds
+    start_times = timestamps[:, 0] - timestamps[0, 0]
+    duration = timestamps[-1, 1] - timestamps[0, 0]
+    num_frames = max(int(round(duration * fps)), 1)
+    # Every tick shows the frame with the nearest start time at or before it
+    output_times = np.arange(num_frames) / fps
+    frame_indices = np.searchsorted(start_times, output_times + 0.5 / fps, side="right") - 1
+    return np.clip(frame_indices, 0, len(start_times) - 1)
+
+
+def read_video(video_path: str, change_fps=True, use_decord=True, fps: int = 25):
+    # The frame rate is changed while decoding, so no intermediate video is encoded
+    frame_indices = None
     if change_fps:
-        temp_dir = "temp"
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        os.makedirs(temp_dir, exist_ok=True)
-        command = (
-            f"ffmpeg -loglevel error -y -nostdin -i {video_path} -r 25 -crf 18 {os.path.join(temp_dir, 'video.mp4')}"
-        )
-        subprocess.run(command, shell=True)
-        target_video_path = os.path.join(temp_dir, "video.mp4")
-    else:
-        target_video_path = video_path
+        video_reader = VideoReader(video_path)
+        frame_indices = get_resampled_frame_indices(video_reader, fps)
+        del video_reader
 
     if use_decord:
-        return read_video_decord(target_video_path)
+        return read_video_decord(video_path, frame_indices)
     else:
-        return read_video_cv2(target_video_path)
+        return read_video_cv2(video_path, frame_indices)
 
 
-def read_video_decord(video_path: str):
+def read_video_decord(video_path: str, frame_indices: np.ndarray = None):
     vr = VideoReader(video_path)
-    video_frames = vr[:].asnumpy()
+    if frame_indices is None:
+        video_frames = vr[:].asnumpy()
+    else:
+        unique_indices, inverse = np.unique(frame_indices, return_inverse=True)
+        video_frames = vr.get_batch(unique_indices).asnumpy()[inverse]
     vr.seek(0)
     return video_frames
 
 
-def read_video_cv2(video_path: str):
+def read_video_cv2(video_path: str, frame_indices: np.ndarray = None):
     # Open the video file
     cap = cv2.VideoCapture(video_path)
 
@@ -80,8 +98,11 @@ def read_video_cv2(video_path: str):
         return np.array([])
 
     frames = []
+    # How many times every source frame is kept, when the frame rate is changed
+    frame_counts = None if frame_indices is None else np.bincount(frame_indices)
 
-    while True:
+    index = 0
+    while frame_counts is None or index < len(frame_counts):
         # Read a frame
         ret, frame = cap.read()
 
@@ -89,10 +110,15 @@ def read_video_cv2(video_path: str):
         if not ret:
             break
 
+        count = 1 if frame_counts is None else frame_counts[index]
+        index += 1
+        if count == 0:
+            continue
+
         # Convert BGR to RGB
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
-        frames.append(frame_rgb)
+        frames += [frame_rgb] * count
 
     # Release the video capture object
     cap.release()
@@ -100,27 +126,67 @@ def read_video_cv2(video_path: str):
     return np.array(frames)
 
 
+def loop_video_indices(start: int, end: int, num_video_frames: int) -> np.ndarray:
+    """
+    Map the output frame indices [start, end) to frame indices of the source video. When the audio is
+    longer than the video, the video is played forward and backward alternately, as in `LipsyncPipeline.loop_video`.
+    """
+    period = 2 * num_video_frames
+    positions = np.arange(start, end) % period
+    return np.where(positions < num_video_frames, positions, period - 1 - positions)
+
+
+class VideoFrameReader:
+    """
+    Random access frame reader which only decodes the frames that are requested. If `fps` is given, the frames are
+    indexed at that frame rate, see `get_resampled_frame_indices`.
+    """
+
+    def __init__(self, video_path: str, fps: int = None):
+        self.video_reader = VideoReader(video_path)
+        self.frame_indices = None if fps is None else get_resampled_frame_indices(self.video_reader, fps)
+
+    def __len__(self):
+        if self.frame_indices is not None:
+            return len(self.frame_indices)
+        return len(self.video_reader)
+
+    def get_frames(self, indices) -> np.ndarray:
+        indices = np.asarray(indices)
+        if self.frame_indices is not None:
+            indices = self.frame_indices[indices]
+        # Decode in ascending order, so a backward (looped) window costs a single seek
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+        frames = self.video_reader.get_batch(unique_indices).asnumpy()
+        return frames[inverse]
+
+    def close(self):
+        self.video_reader.seek(0)  # avoid memory leak
+
+
 def read_audio(audio_path: str, audio_sample_rate: int = 16000):
     if audio_path is None:
         raise ValueError("Audio path is required.")
-    ar = AudioReader(audio_path, sample_rate=audio_sample_rate, mono=True)
-
-    # To access the audio samples
-    audio_samples = torch.from_numpy(ar[:].asnumpy())
-    audio_samples = audio_samples.squeeze(0)
+    # The same decoding as the whisper features, so one decoded buffer can feed both, and 16 kHz mono WAV files
+    # are read without launching ffmpeg
+    audio_samples = torch.from_numpy(load_audio(audio_path, sr=audio_sample_rate))
 
     return audio_samples
 
 
-def write_video(video_output_path: str, video_frames: np.ndarray, fps: int):
-    with imageio.get_writer(
+def open_video_writer(video_output_path: str, fps: int):
+    return imageio.get_writer(
         video_output_path,
         fps=fps,
         codec="libx264",
         macro_block_size=None,
         ffmpeg_params=["-crf", "13"],
         ffmpeg_log_level="error",
-    ) as writer:
+    )
+
+
+def write_video(video_output_path: str, video_frames: np.ndarray, fps: int):
+    with open_video_writer(video_output_path, fps) as writer:
         for video_frame in video_frames:
             writer.append_data(video_frame)
 
@@ -135,6 +201,129 @@ def write_video_cv2(video_output_path: str, video_frames: np.ndarray, fps: int):
     out.release()
 
 
+class FFmpegVideoWriter:
+    """
+    Encode frames with a single ffmpeg process, muxed with the audio samples. The RGB frames are written to its stdin
+    as they come, and the float32 mono audio is fed through a second pipe by a background thread, so no intermediate
+    file is written and the output can be produced incrementally.
+
+    When used as a context manager, an exception kills ffmpeg and removes the partial output instead.
+    """
+
+    def __init__(
+        self,
+        video_output_path: str,
+        fps: int,
+        audio_samples: np.ndarray = None,
+        audio_sample_rate: int = 16000,
+        crf: int = 18,
+    ):
+        self.video_output_path = video_output_path
+        self.fps = fps
+        self.audio_samples = audio_samples
+        self.audio_sample_rate = audio_sample_rate
+        self.crf = crf
+        self.process = None
+        self.audio_thread = None
+
+    def _open(self, height: int, width: int):
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-nostdin"]
+        command += [
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(self.fps),
+            "-i",
+            "pipe:0",
+        ]
+        pass_fds = ()
+        if self.audio_samples is not None:
+            audio_read_fd, audio_write_fd = os.pipe()
+            pass_fds = (audio_read_fd,)
+            command += ["-f", "f32le", "-ar", str(self.audio_sample_rate), "-ac", "1", "-i", f"pipe:{audio_read_fd}"]
+        command += ["-c:v", "libx264", "-crf", str(self.crf), "-pix_fmt", "yuv420p"]
+        if self.audio_samples is not None:
+            command += ["-c:a", "aac", "-q:a", "0"]
+        command.append(self.video_output_path)
+
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, pass_fds=pass_fds)
+        except Exception:
+            if self.audio_samples is not None:
+                os.close(audio_read_fd)
+                os.close(audio_write_fd)
+            raise
+        if self.audio_samples is not None:
+            os.close(audio_read_fd)
+            audio_bytes = np.ascontiguousarray(self.audio_samples, dtype=np.float32).tobytes()
+            self.audio_thread = threading.Thread(
+                target=self._write_audio, args=(audio_write_fd, audio_bytes), daemon=True
+            )
+            self.audio_thread.start()
+
+    @staticmethod
+    def _write_audio(audio_write_fd: int, audio_bytes: bytes):
+        try:
+            with os.fdopen(audio_write_fd, "wb") as f:
+                f.write(audio_bytes)
+        except BrokenPipeError:  # ffmpeg failed, reported by close()
+            pass
+
+    def write_frames(self, video_frames: np.ndarray):
+        if len(video_frames) == 0:
+            return
+        if self.process is None:
+            self._open(*video_frames.shape[1:3])
+        try:
+            self.process.stdin.write(np.ascontiguousarray(video_frames, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            self.close()
+
+    def close(self):
+        if self.process is None:
+            return
+        if not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = self.process.wait()
+        if self.audio_thread is not None:
+            self.audio_thread.join()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {returncode} while writing {self.video_output_path}")
+
+    def abort(self):
+        """
+        Kill ffmpeg and remove the partial output, instead of finalizing a truncated video
+        """
+        if self.process is None:
+            return
+        self.process.kill()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        if self.audio_thread is not None:
+            self.audio_thread.join()
+        if os.path.exists(self.video_output_path):
+            os.remove(self.video_output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 def init_dist(backend="nccl", **kwargs):
     """Initializes distributed environment."""
     rank = int(os.environ["RANK"])
@@ -1,10 +1,13 @@
 # Adapted from https://github.com/TMElyralab/MuseTalk/blob/main/musetalk/whisper/audio2feature.py
 
-from .whisper import load_model
+from .whisper import load_model, encoder_features
+from ..utils.audio_embeds_cache import AudioEmbedsCache
+from ..utils.disk_cache import hash_file
+import hashlib
+import math
 import numpy as np
 import torch
 import os
-from pathlib import Path
 
 
 class Audio2Feature:
@@ -15,14 +18,44 @@ class Audio2Feature:
         audio_embeds_cache_dir=None,
         num_frames=16,
         audio_feat_length=[2, 2],
+        encoder_batch_size=16,
+        embedding_layers=None,
+        variable_length_encoding=False,
+        audio_embeds_cache_size_bytes=-1,
     ):
-        self.model = load_model(model_path, device)
+        # Only the encoder is used to compute the audio features
+        self.model = load_model(model_path, device, encoder_only=True)
+        self.model_path = model_path
         self.audio_embeds_cache_dir = audio_embeds_cache_dir
-        if audio_embeds_cache_dir is not None and audio_embeds_cache_dir != "":
-            Path(audio_embeds_cache_dir).mkdir(parents=True, exist_ok=True)
         self.num_frames = num_frames
         self.embedding_dim = self.model.dims.n_audio_state
         self.audio_feat_length = audio_feat_length
+        self.encoder_batch_size = encoder_batch_size
+        # The encoder layers whose embeddings make up the audio feature, 0 being the encoder input, all by default
+        self.embedding_layers = embedding_layers
+        # Encode the last segment at its actual length, faster but not identical to the padded encoding
+        self.variable_length_encoding = variable_length_encoding
+
+        self.audio_embeds_cache = None
+        if audio_embeds_cache_dir is not None and audio_embeds_cache_dir != "":
+            self.audio_embeds_cache = AudioEmbedsCache(
+                audio_embeds_cache_dir, self.get_model_id(), max_size_bytes=audio_embeds_cache_size_bytes
+            )
+
+    def get_model_id(self):
+        """
+        Identity of everything the cached embeddings depend on: the checkpoint content, and which embeddings are
+        kept and how the last segment is encoded
+        """
+        if os.path.isfile(self.model_path):
+            checkpoint_id = hash_file(self.model_path)
+        else:  # an official model name, downloaded and checked by `load_model`
+            checkpoint_id = self.model_path
+        embedding_layers = self.embedding_layers
+        if embedding_layers is None:
+            embedding_layers = list(range(self.model.dims.n_audio_layer + 1))
+        model_id = f"{checkpoint_id}_{self.model.dims}_{list(embedding_layers)}_{self.variable_length_encoding}"
+        return hashlib.sha256(model_id.encode()).hexdigest()[:16]
 
     def get_sliced_feature(self, feature_array, vid_idx, fps=25):
         """
@@ -51,6 +84,26 @@ class Audio2Feature:
         selected_feature = selected_feature.reshape(-1, self.embedding_dim)  # 50*384
         return selected_feature, selected_idx
 
+    def get_sliced_feature_indices(self, num_features: int, vid_indices: torch.Tensor, fps=25):
+        """
+        Vectorized version of the indices of `get_sliced_feature`
+        :param num_features: the length of the feature array
+        :param vid_indices: (n,) the video frame indices
+        :return: (n, window) clamped feature indices of every video frame
+        """
+        center_indices = (vid_indices.to(torch.float64) * 50 / fps).long()
+        offsets = torch.arange(-self.audio_feat_length[0] * 2, (self.audio_feat_length[1] + 1) * 2)
+        return (center_indices[:, None] + offsets).clamp(0, num_features - 1)
+
+    def get_sliced_features(self, feature_array, vid_indices: torch.Tensor, fps=25):
+        """
+        Get the sliced features of several video frames with one gather
+        :return: (n, window * num_layers, embedding_dim) contiguous tensor
+        """
+        selected_idx = self.get_sliced_feature_indices(len(feature_array), vid_indices, fps)
+        selected_feature = feature_array[selected_idx.to(feature_array.device)]
+        return selected_feature.reshape(len(vid_indices), -1, self.embedding_dim)  # n*50*384
+
     def get_sliced_feature_sparse(self, feature_array, vid_idx, fps=25):
         """
         Get sliced features based on a given index
@@ -85,68 +138,119 @@ class Audio2Feature:
         selected_feature = torch.from_numpy(selected_feature)
         return selected_feature, selected_idx
 
-    def feature2chunks(self, feature_array, fps):
-        whisper_chunks = []
+    @staticmethod
+    def get_num_chunks(num_features: int, fps):
+        # The chunks run up to and including the first video frame that starts after the end of the audio
         whisper_idx_multiplier = 50.0 / fps
-        i = 0
-        print(f"video in {fps} FPS, audio idx in 50FPS")
+        last_idx = max(math.ceil((num_features + 1) / whisper_idx_multiplier) - 1, 0)
+        while int(last_idx * whisper_idx_multiplier) <= num_features:
+            last_idx += 1
+        return last_idx + 1
 
-        while True:
-            start_idx = int(i * whisper_idx_multiplier)
-            selected_feature, selected_idx = self.get_sliced_feature(feature_array=feature_array, vid_idx=i, fps=fps)
-            # print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-            if start_idx > len(feature_array):
-                break
+    def feature2chunks(self, feature_array, fps):
+        """
+        The chunks of all the video frames of the audio at once, which take memory in proportion to its length. The
+        streaming inference gathers the chunks of each window with `get_sliced_features` instead
+        """
+        print(f"video in {fps} FPS, audio idx in 50FPS")
 
+        num_chunks = self.get_num_chunks(len(feature_array), fps)
+        whisper_chunks = self.get_sliced_features(feature_array, torch.arange(num_chunks), fps=fps)
         return whisper_chunks
 
-    def _audio2feat(self, audio_path: str):
-        # get the sample rate of the audio
-        result = self.model.transcribe(audio_path)
-        embed_list = []
-        for emb in result["segments"]:
-            encoder_embeddings = emb["encoder_embeddings"]
-            encoder_embeddings = encoder_embeddings.transpose(0, 2, 1, 3)
-            encoder_embeddings = encoder_embeddings.squeeze(0)
-            start_idx = int(emb["start"])
-            end_idx = int(emb["end"])
-            emb_end_idx = int((end_idx - start_idx) / 2)
-            embed_list.append(encoder_embeddings[:emb_end_idx])
-        concatenated_array = torch.from_numpy(np.concatenate(embed_list, axis=0))
-        return concatenated_array
-
-    def audio2feat(self, audio_path):
-        if self.audio_embeds_cache_dir == "" or self.audio_embeds_cache_dir is None:
-            return self._audio2feat(audio_path)
-
-        audio_embeds_cache_path = os.path.join(
-            self.audio_embeds_cache_dir, os.path.basename(audio_path).replace(".mp4", "_embeds.pt")
+    def _audio2feat(self, audio):
+        # All the 30-second segments go through the encoder in batches, the result stays on the model's device
+        return encoder_features(
+            self.model,
+            audio,
+            max_batch_size=self.encoder_batch_size,
+            layers=self.embedding_layers,
+            variable_length=self.variable_length_encoding,
         )
 
-        if os.path.isfile(audio_embeds_cache_path):
-            try:
-                audio_feat = torch.load(audio_embeds_cache_path, weights_only=True)
-            except Exception as e:
-                print(f"{type(e).__name__} - {e} - {audio_embeds_cache_path}")
-                os.remove(audio_embeds_cache_path)
-                audio_feat = self._audio2feat(audio_path)
-                torch.save(audio_feat, audio_embeds_cache_path)
-        else:
-            audio_feat = self._audio2feat(audio_path)
-            torch.save(audio_feat, audio_embeds_cache_path)
+    def audio2feat(self, audio_path, audio_samples=None):
+        """
+        :param audio_path: the audio file, which identifies the cache entry
+        :param audio_samples: the 16 kHz mono waveform of the audio file if it is already decoded, then the file is
+            not decoded again
+        """
+        audio = audio_path if audio_samples is None else audio_samples
+        if self.audio_embeds_cache is None:
+            return self._audio2feat(audio)
+
+        key = self.audio_embeds_cache.get_key(audio_path)
+        audio_feat = self.audio_embeds_cache.load(key, map_location=self.model.device)
+        if audio_feat is None:
+            audio_feat = self._audio2feat(audio)
+            self.audio_embeds_cache.save(key, audio_feat.cpu())
 
         return audio_feat
 
     def crop_overlap_audio_window(self, audio_feat, start_index):
-        selected_feature_list = []
-        for i in range(start_index, start_index + self.num_frames):
-            selected_feature, selected_idx = self.get_sliced_feature(feature_array=audio_feat, vid_idx=i, fps=25)
-            selected_feature_list.append(selected_feature)
-        mel_overlap = torch.stack(selected_feature_list)
+        mel_overlap = self.get_sliced_features(
+            audio_feat, torch.arange(start_index, start_index + self.num_frames), fps=25
+        )
         return mel_overlap
 
+    def read_overlap_audio_window(self, feature_store, key, start_index):
+        """
+        Same as `crop_overlap_audio_window`, reading only the rows of the window from a `FeatureStore` of
+        embeddings instead of loading the whole audio feature
+        """
+        selected_idx = self.get_sliced_feature_indices(
+            feature_store.get_num_rows(key), torch.arange(start_index, start_index + self.num_frames), fps=25
+        )
+        first_idx = int(selected_idx.min())
+        rows = torch.from_numpy(feature_store.read(key, first_idx, int(selected_idx.max()) + 1))
+        return rows[selected_idx - first_idx].reshape(self.num_frames, -1, self.embedding_dim)
+
+
+class AudioEmbedsReader:
+    """
+    Crops the audio windows of `Audio2Feature.crop_overlap_audio_window` from already computed embeddings, those
+    of a `FeatureStore` or of the embedding cache of the `Audio2Feature`, without its whisper model. It can run in
+    the dataloader workers, a miss is left to the `Audio2Feature` of the main process.
+
+    The embedding cache is only looked up with the content hashes computed beforehand, in `content_hashes` by path
+    or given to `read`, so that the workers never read the videos to hash them. Without them, i.e. without a
+    `dataset_index_path` built by preprocess/build_dataset_index.py, every lookup misses.
+    """
+
+    # Only depend on the window parameters
+    get_sliced_feature_indices = Audio2Feature.get_sliced_feature_indices
+    get_sliced_features = Audio2Feature.get_sliced_features
+    crop_overlap_audio_window = Audio2Feature.crop_overlap_audio_window
+    read_overlap_audio_window = Audio2Feature.read_overlap_audio_window
+
+    def __init__(self, audio_encoder: Audio2Feature, feature_store=None):
+        self.audio_embeds_cache = audio_encoder.audio_embeds_cache
+        self.feature_store = feature_store
+        self.num_frames = audio_encoder.num_frames
+        self.audio_feat_length = audio_encoder.audio_feat_length
+        self.embedding_dim = audio_encoder.embedding_dim
+        num_layers = audio_encoder.model.dims.n_audio_layer + 1
+        if audio_encoder.embedding_layers is not None:
+            num_layers = len(audio_encoder.embedding_layers)
+        window = (self.audio_feat_length[0] + self.audio_feat_length[1] + 1) * 2
+        self.embeds_shape = (self.num_frames, window * num_layers, self.embedding_dim)
+        self.content_hashes = {}
+
+    def read(self, video_path: str, start_index: int, content_hash: str = None):
+        """
+        :return: (num_frames, window * num_layers, embedding_dim) on the CPU, None if the embeddings are not computed
+            or the content hash of the video is unknown
+        """
+        if self.feature_store is not None and video_path in self.feature_store:
+            return self.read_overlap_audio_window(self.feature_store, video_path, start_index)
+        if content_hash is None:
+            content_hash = self.content_hashes.get(video_path)
+        if self.audio_embeds_cache is None or content_hash is None:
+            return None
+        audio_feat = self.audio_embeds_cache.load(self.audio_embeds_cache.get_key(video_path, content_hash))
+        if audio_feat is None:
+            return None
+        return self.crop_overlap_audio_window(audio_feat, start_index)
+
 
 if __name__ == "__main__":
     audio_encoder = Audio2Feature(model_path="checkpoints/whisper/tiny.pt")
@@ -0,0 +1,173 @@
+import torch
+
+from .audio2feature import Audio2Feature
+from .whisper.audio import (
+    HOP_LENGTH,
+    N_FFT,
+    N_FRAMES,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    log10_mel_spectrogram,
+    normalize_log_spec,
+)
+
+# The encoder halves the number of mel frames, a feature is 20 ms of audio
+SAMPLES_PER_FEATURE = 2 * HOP_LENGTH
+FEATURES_PER_SEGMENT = N_FRAMES // 2
+# The feature j only depends on the mel frames up to 2j+2 (two convolutions of kernel 3, the second one of stride 2),
+# and the mel frame t on the samples up to t*160+200, so it is final once 320j+520 samples are known
+FEATURE_LOOKAHEAD_SAMPLES = 2 * HOP_LENGTH + N_FFT // 2
+# Samples before a segment used to compute its first mel frames like the mel spectrogram of the whole audio does
+MEL_MARGIN_SAMPLES = 3 * HOP_LENGTH
+
+
+class StreamingAudio2Feature:
+    """
+    Incremental version of `Audio2Feature.audio2feat` followed by `feature2chunks`, for audio received in packets.
+    `push` returns the chunks of the video frames whose right context (`audio_feat_length[1]`) is available, in
+    the layout of `feature2chunks`, and `flush` the remaining chunks at the end of the audio.
+
+    Every update re-encodes the 30-second segment of the offline encoding that contains the new features, padded
+    like the offline one, and keeps the mel frames and the positions of the offline segments. Only the rolling mel
+    normalization and the attention of the encoder to the not yet received audio differ from the offline features.
+    Only the current segment of the audio is kept in memory.
+    """
+
+    def __init__(self, audio_encoder: Audio2Feature, fps=25):
+        self.audio_encoder = audio_encoder
+        self.fps = fps
+        self.model = audio_encoder.model
+        self.device = self.model.device
+        self.dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+        self.layers = audio_encoder.embedding_layers
+        if self.layers is None:
+            self.layers = list(range(self.model.dims.n_audio_layer + 1))
+        self.right_context = (audio_encoder.audio_feat_length[1] + 1) * 2
+        self.left_context = audio_encoder.audio_feat_length[0] * 2
+        self.reset()
+
+    def reset(self):
+        self.samples = torch.zeros(0)
+        self.samples_start = 0
+        self.num_samples = 0
+        # The final features, from the absolute feature index `features_start` on
+        self.features = torch.zeros(
+            (0, len(self.layers), self.audio_encoder.embedding_dim), device=self.device, dtype=self.dtype
+        )
+        self.features_start = 0
+        self.num_features = 0
+        self.max_log_spec = None
+        self.num_emitted_frames = 0
+        self.finished = False
+
+    @property
+    def algorithmic_latency(self):
+        """
+        The seconds of audio past the start of a video frame needed to emit its chunk. Waiting for the packet that
+        completes it adds up to one packet duration
+        """
+        return ((self.right_context - 1) * SAMPLES_PER_FEATURE + FEATURE_LOOKAHEAD_SAMPLES) / SAMPLE_RATE
+
+    def get_last_feature_index(self, frame_idx: int):
+        return int(frame_idx * 50 / self.fps) + self.right_context - 1
+
+    def push(self, samples) -> torch.Tensor:
+        """
+        :param samples: the next 16 kHz mono samples of the audio
+        :return: (n, window * num_layers, embedding_dim), the chunks of the next n video frames, n may be 0
+        """
+        if self.finished:
+            raise RuntimeError("The audio was flushed, call `reset` to start a new one")
+        samples = torch.as_tensor(samples, dtype=torch.float32).flatten()
+        self.samples = torch.cat([self.samples, samples])
+        self.num_samples += len(samples)
+
+        num_final_features = max((self.num_samples - FEATURE_LOOKAHEAD_SAMPLES) // SAMPLES_PER_FEATURE + 1, 0)
+        # Only encode when a video frame can be emitted
+        if self.get_last_feature_index(self.num_emitted_frames) < num_final_features:
+            self._encode(num_final_features)
+
+        num_frames = self.num_emitted_frames
+        while self.get_last_feature_index(num_frames) < self.num_features:
+            num_frames += 1
+        return self._emit(num_frames)
+
+    def flush(self) -> torch.Tensor:
+        """
+        :return: the chunks of the remaining video frames, up to the count of `feature2chunks` for the whole audio
+        """
+        self.finished = True
+        # As many features as the offline encoding
+        self._encode(self.num_samples // SAMPLES_PER_FEATURE)
+        if self.num_features == 0:
+            return self._emit(self.num_emitted_frames)
+        return self._emit(max(Audio2Feature.get_num_chunks(self.num_features, self.fps), self.num_emitted_frames))
+
+    def _encode(self, num_final_features: int):
+        while self.num_features < num_final_features:
+            segment = self.num_features // FEATURES_PER_SEGMENT
+            segment_start = segment * FEATURES_PER_SEGMENT
+            segment_end = min(segment_start + FEATURES_PER_SEGMENT, num_final_features)
+            features = self._encode_segment(segment)
+            self.features = torch.cat([self.features, features[self.num_features - segment_start : segment_end]])
+            self.num_features = segment_end
+
+        # Drop the audio of the previous segments, and the features out of the window of the next video frame
+        samples_start = max((self.num_features // FEATURES_PER_SEGMENT) * N_SAMPLES - MEL_MARGIN_SAMPLES, 0)
+        self.samples = self.samples[samples_start - self.samples_start :]
+        self.samples_start = samples_start
+        features_start = max(int(self.num_emitted_frames * 50 / self.fps) - self.left_context, 0)
+        features_start = min(features_start, self.num_features)
+        if features_start > self.features_start:
+            self.features = self.features[features_start - self.features_start :]
+            self.features_start = features_start
+
+    def _encode_segment(self, segment: int) -> torch.Tensor:
+        start = segment * N_SAMPLES
+        margin = min(start, MEL_MARGIN_SAMPLES)
+        end = min(start + N_SAMPLES + MEL_MARGIN_SAMPLES, self.num_samples)
+        audio = self.samples[start - margin - self.samples_start : end - self.samples_start].to(self.device)
+
+        log_spec = log10_mel_spectrogram(audio)[:, margin // HOP_LENGTH : margin // HOP_LENGTH + N_FRAMES]
+        # The offline normalization uses the maximum of the whole audio, use the maximum so far
+        max_log_spec = log_spec.max()
+        if self.max_log_spec is not None:
+            max_log_spec = torch.maximum(max_log_spec, self.max_log_spec)
+        self.max_log_spec = max_log_spec
+        mel = normalize_log_spec(log_spec, max_log_spec)
+        if not self.audio_encoder.variable_length_encoding:
+            mel = torch.nn.functional.pad(mel, (0, N_FRAMES - mel.shape[-1]))
+
+        with torch.no_grad():
+            return self.model.encoder.forward_embeddings(mel[None].to(self.dtype), self.layers)[0]
+
+    def _emit(self, num_frames: int) -> torch.Tensor:
+        vid_indices = torch.arange(self.num_emitted_frames, num_frames)
+        self.num_emitted_frames = num_frames
+        if len(vid_indices) == 0:
+            window = self.left_context + self.right_context
+            return self.features.new_zeros((0, window * len(self.layers), self.audio_encoder.embedding_dim))
+
+        selected_idx = self.audio_encoder.get_sliced_feature_indices(self.num_features, vid_indices, fps=self.fps)
+        selected_feature = self.features[(selected_idx - self.features_start).to(self.device)]
+        return selected_feature.reshape(len(vid_indices), -1, self.audio_encoder.embedding_dim)
+
+
+if __name__ == "__main__":
+    from .whisper.audio import load_audio
+
+    audio_encoder = Audio2Feature(model_path="checkpoints/whisper/tiny.pt", device="cuda")
+    audio_samples = load_audio("assets/demo1_audio.wav")
+    offline_chunks = audio_encoder.feature2chunks(audio_encoder.audio2feat("assets/demo1_audio.wav"), fps=25)
+
+    streaming = StreamingAudio2Feature(audio_encoder, fps=25)
+    packet_size = SAMPLE_RATE // 5  # 200 ms
+    chunks = []
+    for start in range(0, len(audio_samples), packet_size):
+        chunks.append(streaming.push(audio_samples[start : start + packet_size]))
+    chunks.append(streaming.flush())
+    chunks = torch.cat(chunks)
+
+    print(f"algorithmic latency: {streaming.algorithmic_latency * 1000:.1f} ms + packet of {packet_size} samples")
+    print(f"chunks: {tuple(chunks.shape)}, offline chunks: {tuple(offline_chunks.shape)}")
+    print(f"max abs diff to the offline chunks: {(chunks.float() - offline_chunks.float()).abs().max().item():.4f}")
@@ -1,4 +1,5 @@
 import hashlib
+import importlib
 import io
 import os
 import urllib
@@ -9,9 +10,8 @@ import torch
 from tqdm import tqdm
 
 from .audio import load_audio, log_mel_spectrogram, pad_or_trim
-from .decoding import DecodingOptions, DecodingResult, decode, detect_language
 from .model import Whisper, ModelDimensions
-from .transcribe import transcribe
+from .encoder_features import encoder_features
 
 
 _MODELS = {
@@ -67,13 +67,36 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
     return model_bytes if in_memory else download_target
 
 
+_LAZY_ATTRIBUTES = {
+    "DecodingOptions": "decoding",
+    "DecodingResult": "decoding",
+    "decode": "decoding",
+    "detect_language": "decoding",
+    "transcribe": "transcribe",
+}
+
+
+def __getattr__(name: str):
+    # The decoding side pulls in the tokenizer and transformers, so it is only imported when used
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f".{_LAZY_ATTRIBUTES[name]}", __name__)
+    # Importing a submodule binds its name in this package, e.g. `transcribe`, so rebind the attribute itself
+    globals()[name] = getattr(module, name)
+    return globals()[name]
+
+
 def available_models() -> List[str]:
     """Returns the names of available models"""
     return list(_MODELS.keys())
 
 
 def load_model(
-    name: str, device: Optional[Union[str, torch.device]] = None, download_root: str = None, in_memory: bool = False
+    name: str,
+    device: Optional[Union[str, torch.device]] = None,
+    download_root: str = None,
+    in_memory: bool = False,
+    encoder_only: bool = False,
 ) -> Whisper:
     """
     Load a Whisper ASR model
@@ -89,6 +112,9 @@ def load_model(
         path to download the model files; by default, it uses "~/.cache/whisper"
     in_memory: bool
         whether to preload the model weights into host memory
+    encoder_only: bool
+        whether to build and load the audio encoder only, enough to compute audio embeddings. The decoder
+        weights are then not read from the checkpoint nor moved to the device
 
     Returns
     -------
@@ -108,13 +134,24 @@ def load_model(
     else:
         raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
 
-    with io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb") as fp:
-        checkpoint = torch.load(fp, map_location=device, weights_only=True)
+    if encoder_only:
+        # Memory-map the checkpoint, so that only the encoder weights are actually read
+        if in_memory:
+            checkpoint = torch.load(io.BytesIO(checkpoint_file), map_location="cpu", weights_only=True)
+        else:
+            checkpoint = torch.load(checkpoint_file, map_location="cpu", mmap=True, weights_only=True)
+    else:
+        with io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb") as fp:
+            checkpoint = torch.load(fp, map_location=device, weights_only=True)
     del checkpoint_file
 
     dims = ModelDimensions(**checkpoint["dims"])
-    model = Whisper(dims)
-    model.load_state_dict(checkpoint["model_state_dict"])
+    model = Whisper(dims, encoder_only=encoder_only)
+    state_dict = checkpoint["model_state_dict"]
+    if encoder_only:
+        state_dict = {key: value for key, value in state_dict.items() if key.startswith("encoder.")}
+    model.load_state_dict(state_dict)
+    del state_dict
 
     del checkpoint
     torch.cuda.empty_cache()
@@ -1,6 +1,7 @@
 import os
+import wave
 from functools import lru_cache
-from typing import Union
+from typing import Optional, Union
 
 import ffmpeg
 import numpy as np
@@ -19,6 +20,28 @@ N_SAMPLES = CHUNK_LENGTH * SAMPLE_RATE  # 480000: number of samples in a chunk
 N_FRAMES = exact_div(N_SAMPLES, HOP_LENGTH)  # 3000: number of frames in a mel spectrogram input
 
 
+def load_wav_pcm16(file: str, sr: int = SAMPLE_RATE):
+    """
+    Read a 16-bit PCM mono WAV file that is already at the sample rate `sr` without launching ffmpeg
+
+    Returns
+    -------
+    A NumPy array containing the audio waveform, in float32 dtype, identical to what `load_audio` decodes, or
+    None when the file is not such a WAV file
+    """
+    if not file.lower().endswith(".wav"):
+        return None
+    try:
+        with wave.open(file, "rb") as f:
+            if f.getnchannels() != 1 or f.getsampwidth() != 2 or f.getframerate() != sr:
+                return None
+            out = f.readframes(f.getnframes())
+    except (wave.Error, EOFError):
+        return None
+
+    return np.frombuffer(out, "<i2").astype(np.float32) / 32768.0
+
+
 def load_audio(file: str, sr: int = SAMPLE_RATE):
     """
     Open an audio file and read as mono waveform, resampling as necessary
@@ -35,6 +58,10 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     -------
     A NumPy array containing the audio waveform, in float32 dtype.
     """
+    audio = load_wav_pcm16(file, sr)
+    if audio is not None:
+        return audio
+
     try:
         # This launches a subprocess to decode audio while down-mixing and resampling as necessary.
         # Requires the ffmpeg CLI and `ffmpeg-python` package to be installed.
@@ -106,6 +133,13 @@ def log_mel_spectrogram(audio: Union[str, np.ndarray, torch.Tensor], n_mels: int
     torch.Tensor, shape = (80, n_frames)
         A Tensor that contains the Mel spectrogram
     """
+    return normalize_log_spec(log10_mel_spectrogram(audio, n_mels))
+
+
+def log10_mel_spectrogram(audio: Union[str, np.ndarray, torch.Tensor], n_mels: int = N_MELS):
+    """
+    The log10 Mel spectrogram of `log_mel_spectrogram`, before its dynamic range is limited and it is rescaled
+    """
     if not torch.is_tensor(audio):
         if isinstance(audio, str):
             audio = load_audio(audio)
@@ -119,7 +153,15 @@ def log_mel_spectrogram(audio: Union[str, np.ndarray, torch.Tensor], n_mels: int
     filters = mel_filters(audio.device, n_mels)
     mel_spec = filters @ magnitudes
 
-    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    return torch.clamp(mel_spec, min=1e-10).log10()
+
+
+def normalize_log_spec(log_spec: torch.Tensor, max_value: Optional[float] = None):
+    """
+    Limit the dynamic range of a log10 Mel spectrogram to 8 below `max_value`, its maximum by default, and rescale it
+    """
+    if max_value is None:
+        max_value = log_spec.max()
+    log_spec = torch.maximum(log_spec, torch.as_tensor(max_value, dtype=log_spec.dtype, device=log_spec.device) - 8.0)
     log_spec = (log_spec + 4.0) / 4.0
     return log_spec
@@ -0,0 +1,91 @@
+import warnings
+from typing import List, Optional, Union, TYPE_CHECKING
+
+import numpy as np
+import torch
+
+from .audio import N_FRAMES, log_mel_spectrogram, pad_or_trim
+
+if TYPE_CHECKING:
+    from .model import Whisper
+
+
+@torch.no_grad()
+def encoder_features(
+    model: "Whisper",
+    audio: Union[str, np.ndarray, torch.Tensor],
+    *,
+    max_batch_size: int = 16,
+    fp16: bool = True,
+    layers: Optional[List[int]] = None,
+    variable_length: bool = False,
+) -> torch.Tensor:
+    """
+    Compute the encoder embeddings of an audio, i.e. what `transcribe` returns as the "encoder_embeddings" of its
+    segments, concatenated and trimmed to the length of the audio. All the 30-second segments are stacked into
+    batches, so that long audio takes a few encoder calls instead of one per segment.
+
+    Parameters
+    ----------
+    model: Whisper
+        The Whisper model instance
+
+    audio: Union[str, np.ndarray, torch.Tensor]
+        The path to the audio file to open, or the audio waveform
+
+    max_batch_size: int
+        The maximum number of segments encoded at once, bounds the memory
+
+    fp16: bool
+        Whether to run the encoder in half precision, ignored on CPU
+
+    layers: List[int]
+        The embeddings to keep, see `AudioEncoder.forward_embeddings`, all of them by default
+
+    variable_length: bool
+        Whether to encode the last segment at its actual length instead of padding it to 30 seconds. Much cheaper
+        for short audio, but the features are NOT identical to the padded ones: the encoder self-attention also
+        attends to the padded frames, so dropping them changes the kept frames. Off by default, the padded encoding
+        is the reference one
+
+    Returns
+    -------
+    A tensor of shape (n_audio_frames, len(layers), n_audio_state) on the device of the model, the embeddings of the
+    encoder input and of the layers, 50 frames per second
+    """
+    dtype = torch.float16 if fp16 else torch.float32
+    if model.device == torch.device("cpu"):
+        if torch.cuda.is_available():
+            warnings.warn("Performing inference on CPU when CUDA is available")
+        if dtype == torch.float16:
+            warnings.warn("FP16 is not supported on CPU; using FP32 instead")
+            dtype = torch.float32
+
+    if layers is None:
+        layers = list(range(model.dims.n_audio_layer + 1))
+
+    mel = log_mel_spectrogram(audio)
+    num_frames = mel.shape[-1]
+    seeks = list(range(0, num_frames, N_FRAMES))
+    num_padded_segments = len(seeks)
+    if variable_length and num_frames - seeks[-1] < N_FRAMES:
+        num_padded_segments -= 1
+    segments = [pad_or_trim(mel[:, seek : seek + N_FRAMES], N_FRAMES) for seek in seeks[:num_padded_segments]]
+
+    # The embeddings of the segments are written in place, one after another, so only the padding of the last
+    # segment has to be trimmed. The encoder halves the number of mel frames
+    n_audio_ctx = model.dims.n_audio_ctx
+    embeddings = torch.empty(
+        (len(seeks), n_audio_ctx, len(layers), model.dims.n_audio_state), device=model.device, dtype=dtype
+    )
+    for start in range(0, num_padded_segments, max_batch_size):
+        batch = torch.stack(segments[start : start + max_batch_size]).to(model.device, dtype=dtype)
+        model.encoder.forward_embeddings(batch, layers, out=embeddings[start : start + max_batch_size])
+
+    if num_padded_segments < len(seeks):
+        last_segment = mel[None, :, seeks[-1] :].to(model.device, dtype=dtype)
+        last_segment_ctx = (last_segment.shape[-1] + 1) // 2
+        model.encoder.forward_embeddings(last_segment, layers, out=embeddings[-1:, :last_segment_ctx])
+
+    num_audio_frames = (len(seeks) - 1) * n_audio_ctx + int((num_frames - seeks[-1]) / 2)
+    return embeddings.flatten(0, 1)[:num_audio_frames]
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from typing import Dict
-from typing import Iterable, Optional
+from typing import Iterable, List, Optional
 
 import numpy as np
 import torch
@@ -8,9 +8,6 @@ import torch.nn.functional as F
 from torch import Tensor
 from torch import nn
 
-from .transcribe import transcribe as transcribe_function
-from .decoding import detect_language as detect_language_function, decode as decode_function
-
 
 @dataclass
 class ModelDimensions:
@@ -170,6 +167,42 @@ class AudioEncoder(nn.Module):
         else:
             return x
 
+    def forward_embeddings(self, x: Tensor, layers: Optional[List[int]] = None, out: Optional[Tensor] = None):
+        """
+        x : torch.Tensor, shape = (batch_size, n_mels, n_ctx)
+            the mel spectrogram of the audio
+        layers : List[int]
+            the embeddings to keep, 0 is the input of the first block and i the output of the i-th block, all of
+            them by default. The blocks after the last kept one are skipped
+        out : torch.Tensor, shape = (batch_size, n_ctx // 2, len(layers), n_state)
+            where to write the embeddings, allocated on the device of `x` if not given
+
+        Unlike `forward(x, include_embeddings=True)`, the embeddings stay on the device of `x`. The input may be
+        shorter than 30 seconds, in which case the positional embedding is truncated to its length
+        """
+        if layers is None:
+            layers = list(range(len(self.blocks) + 1))
+        positions = {layer: position for position, layer in enumerate(layers)}
+
+        x = F.gelu(self.conv1(x))
+        x = F.gelu(self.conv2(x))
+        x = x.permute(0, 2, 1)
+
+        assert x.shape[1] <= self.positional_embedding.shape[0], "incorrect audio shape"
+        x = (x + self.positional_embedding[: x.shape[1]]).to(x.dtype)
+
+        if out is None:
+            out = x.new_empty(x.shape[0], x.shape[1], len(layers), x.shape[2])
+
+        if 0 in positions:
+            out[:, :, positions[0]] = x
+        for i, block in enumerate(self.blocks[: max(layers)], start=1):
+            x = block(x)
+            if i in positions:
+                out[:, :, positions[i]] = x
+
+        return out
+
 
 class TextDecoder(nn.Module):
     def __init__(self, n_vocab: int, n_ctx: int, n_state: int, n_head: int, n_layer: int):
@@ -218,7 +251,7 @@ class TextDecoder(nn.Module):
 
 
 class Whisper(nn.Module):
-    def __init__(self, dims: ModelDimensions):
+    def __init__(self, dims: ModelDimensions, encoder_only: bool = False):
         super().__init__()
         self.dims = dims
         self.encoder = AudioEncoder(
@@ -228,13 +261,16 @@ class Whisper(nn.Module):
             self.dims.n_audio_head,
             self.dims.n_audio_layer,
         )
-        self.decoder = TextDecoder(
-            self.dims.n_vocab,
-            self.dims.n_text_ctx,
-            self.dims.n_text_state,
-            self.dims.n_text_head,
-            self.dims.n_text_layer,
-        )
+        # Without the decoder, only the audio embedding methods can be used
+        self.decoder = None
+        if not encoder_only:
+            self.decoder = TextDecoder(
+                self.dims.n_vocab,
+                self.dims.n_text_ctx,
+                self.dims.n_text_state,
+                self.dims.n_text_head,
+                self.dims.n_text_layer,
+            )
 
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder.forward(mel)
@@ -285,6 +321,19 @@ class Whisper(nn.Module):
         self.decoder.apply(install_hooks)
         return cache, hooks
 
-    detect_language = detect_language_function
-    transcribe = transcribe_function
-    decode = decode_function
+    # The decoding and tokenizer modules are only imported when used, they are not needed by the encoder
+
+    def detect_language(self, *args, **kwargs):
+        from .decoding import detect_language as detect_language_function
+
+        return detect_language_function(self, *args, **kwargs)
+
+    def transcribe(self, *args, **kwargs):
+        from .transcribe import transcribe as transcribe_function
+
+        return transcribe_function(self, *args, **kwargs)
+
+    def decode(self, *args, **kwargs):
+        from .decoding import decode as decode_function
+
+        return decode_function(self, *args, **kwargs)
@@ -0,0 +1,43 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Probe the videos of a fileslist in parallel and save their frame count, fps, duration, audio length, mel
+spectrogram length and content hash, set as `dataset_index_path` in the data config of the U-Net or SyncNet
+training.
+"""
+
+import argparse
+
+from latentsync.data.dataset_index import DatasetIndex
+
+
+def build_dataset_index(fileslist: str, index_path: str, num_workers: int):
+    with open(fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+
+    print(f"Indexing {len(video_paths)} videos...")
+    dataset_index = DatasetIndex.build(video_paths, num_workers)
+    dataset_index.save(index_path)
+    print(f"Saved the index of {len(dataset_index)} videos, {dataset_index.durations.sum() / 3600:.1f} hours")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fileslist", type=str, required=True)
+    parser.add_argument("--index_path", type=str, required=True, help="the .npz file to write")
+    parser.add_argument("--num_workers", type=int, default=50)
+    args = parser.parse_args()
+
+    build_dataset_index(args.fileslist, args.index_path, args.num_workers)
@@ -0,0 +1,129 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pack the mel spectrograms (for SyncNet and the sync loss) or the whisper embeddings (for the U-Net) of the videos
+of a fileslist into a sharded feature store, set as `audio_mel_store_dir` or `audio_embeds_store_dir` in the data
+config. The videos are keyed by their path in the fileslist. A large fileslist can be split into parts built by
+several processes into the same store, e.g. one per GPU for the whisper embeddings.
+"""
+
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import tqdm
+from decord import AudioReader
+
+from latentsync.data.feature_store import FeatureStoreWriter
+from latentsync.utils.audio import get_hop_size, melspectrogram, melspectrogram_torch
+from latentsync.whisper.audio2feature import Audio2Feature
+
+
+def read_audio_samples(video_path: str, audio_sample_rate: int = 16000):
+    try:
+        ar = AudioReader(video_path, sample_rate=audio_sample_rate)
+        return video_path, ar[:].asnumpy().squeeze(0)
+    except Exception as e:
+        print(f"{type(e).__name__} - {e} - {video_path}")
+        return video_path, None
+
+
+def compute_mel(video_path: str):
+    # Same features as `UNetDataset.read_audio`, transposed to (T, 80). Stored as float32 like the torch path, so
+    # that a store filled by both, e.g. a build resumed with the other one, has a single dtype
+    video_path, audio_samples = read_audio_samples(video_path)
+    if audio_samples is None:
+        return video_path, None
+    return video_path, melspectrogram(audio_samples).T.astype(np.float32)
+
+
+def write_mel_batch(batch, writer: FeatureStoreWriter, device: str):
+    video_paths, samples = zip(*batch)
+    lengths = torch.tensor([len(audio_samples) for audio_samples in samples])
+    wavs = torch.zeros(len(samples), int(lengths.max()))
+    for i, audio_samples in enumerate(samples):
+        wavs[i, : len(audio_samples)] = torch.from_numpy(audio_samples)
+    mels = melspectrogram_torch(wavs.to(device), lengths).transpose(1, 2).cpu().numpy()
+    num_mel_frames = lengths // get_hop_size() + 1
+    for video_path, mel, num_frames in zip(video_paths, mels, num_mel_frames.tolist()):
+        writer.add(video_path, mel[:num_frames].astype(np.float32))
+
+
+def build_mel_store(video_paths, writer: FeatureStoreWriter, num_workers: int, device=None, batch_size: int = 32):
+    with Pool(num_workers) as pool:
+        if device is None:
+            # librosa in the worker processes
+            for video_path, mel in tqdm.tqdm(pool.imap_unordered(compute_mel, video_paths), total=len(video_paths)):
+                if mel is not None:
+                    writer.add(video_path, mel)
+            return
+
+        # The workers only decode, the mel spectrograms are computed in batches on the device
+        batch = []
+        results = pool.imap_unordered(read_audio_samples, video_paths)
+        for video_path, audio_samples in tqdm.tqdm(results, total=len(video_paths)):
+            if audio_samples is None:
+                continue
+            batch.append((video_path, audio_samples))
+            if len(batch) == batch_size:
+                write_mel_batch(batch, writer, device)
+                batch = []
+        if batch:
+            write_mel_batch(batch, writer, device)
+
+
+def build_embeds_store(video_paths, writer: FeatureStoreWriter, whisper_model_path: str, device: str):
+    audio_encoder = Audio2Feature(model_path=whisper_model_path, device=device)
+    for video_path in tqdm.tqdm(video_paths):
+        try:
+            audio_feat = audio_encoder.audio2feat(video_path)
+        except Exception as e:
+            print(f"{type(e).__name__} - {e} - {video_path}")
+            continue
+        writer.add(video_path, audio_feat.cpu().numpy())
+
+
+def main(args):
+    with open(args.fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+    video_paths = video_paths[args.part_index :: args.num_parts]
+
+    print(f"Packing the {args.feature} features of {len(video_paths)} videos into {args.store_dir}")
+    with FeatureStoreWriter(
+        args.store_dir, part_name=f"part{args.part_index}", shard_size_bytes=int(args.shard_size_gb * 1024**3)
+    ) as writer:
+        if args.feature == "mel":
+            build_mel_store(video_paths, writer, args.num_workers, args.mel_device, args.mel_batch_size)
+        else:
+            build_embeds_store(video_paths, writer, args.whisper_model_path, args.device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fileslist", type=str, required=True)
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument("--feature", type=str, choices=["mel", "whisper"], required=True)
+    parser.add_argument("--whisper_model_path", type=str, default="checkpoints/whisper/tiny.pt")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_workers", type=int, default=16, help="processes computing the mel spectrograms")
+    parser.add_argument("--mel_device", type=str, default=None, help="compute the mel spectrograms with torch")
+    parser.add_argument("--mel_batch_size", type=int, default=32)
+    parser.add_argument("--num_parts", type=int, default=1)
+    parser.add_argument("--part_index", type=int, default=0)
+    parser.add_argument("--shard_size_gb", type=float, default=4)
+    args = parser.parse_args()
+
+    main(args)
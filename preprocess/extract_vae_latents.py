@@ -0,0 +1,100 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Encode every frame of the videos of a fileslist with the frozen VAE, and pack the latent distribution parameters
+(mean and log-variance) of the frame and of the masked frame into a sharded feature store, set as
+`latent_store_dir` in the data config to train with `UNetLatentDataset`. A large fileslist can be split into parts
+built by several processes into the same store, e.g. one per GPU.
+"""
+
+import argparse
+
+import torch
+import tqdm
+from decord import VideoReader, cpu
+from diffusers import AutoencoderKL
+from omegaconf import OmegaConf
+
+from latentsync.data.feature_store import FeatureStoreWriter
+from latentsync.utils.image_processor import ImageProcessor, load_fixed_mask
+
+
+@torch.no_grad()
+def extract_latent_params(video_path: str, vae, image_processor: ImageProcessor, device, batch_size: int):
+    vr = VideoReader(video_path, ctx=cpu(0))
+    latent_params = []
+    for start in range(0, len(vr), batch_size):
+        frames = vr.get_batch(list(range(start, min(start + batch_size, len(vr))))).asnumpy()
+        pixel_values, masked_pixel_values, _ = image_processor.prepare_masks_and_masked_images(
+            frames, affine_transform=False
+        )
+        pixel_values = pixel_values.to(device, dtype=vae.dtype)
+        masked_pixel_values = masked_pixel_values.to(device, dtype=vae.dtype)
+        latent_params.append(
+            torch.stack(
+                [
+                    vae.encode(pixel_values).latent_dist.parameters,
+                    vae.encode(masked_pixel_values).latent_dist.parameters,
+                ],
+                dim=1,
+            ).cpu()
+        )
+    vr.seek(0)  # avoid memory leak
+    return torch.cat(latent_params)  # (f, 2, 2 * c, h, w)
+
+
+def main(args):
+    config = OmegaConf.load(args.unet_config_path)
+    device = torch.device(args.device)
+
+    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=torch.float16)
+    vae.requires_grad_(False)
+    vae.to(device)
+
+    # The same preprocessing as `UNetDataset`
+    image_processor = ImageProcessor(
+        config.data.resolution, mask_image=load_fixed_mask(config.data.resolution, config.data.mask_image_path)
+    )
+
+    with open(config.data.train_fileslist if args.fileslist is None else args.fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+    video_paths = video_paths[args.part_index :: args.num_parts]
+
+    print(f"Extracting the VAE latents of {len(video_paths)} videos into {args.store_dir}")
+    with FeatureStoreWriter(
+        args.store_dir, part_name=f"part{args.part_index}", shard_size_bytes=int(args.shard_size_gb * 1024**3)
+    ) as writer:
+        for video_path in tqdm.tqdm(video_paths):
+            try:
+                latent_params = extract_latent_params(video_path, vae, image_processor, device, args.batch_size)
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {video_path}")
+                continue
+            writer.add(video_path, latent_params.numpy())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/stage2.yaml")
+    parser.add_argument("--fileslist", type=str, default=None, help="the train fileslist of the config by default")
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--batch_size", type=int, default=32, help="frames encoded at once")
+    parser.add_argument("--num_parts", type=int, default=1)
+    parser.add_argument("--part_index", type=int, default=0)
+    parser.add_argument("--shard_size_gb", type=float, default=4)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,127 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pack the preprocessed clips of a fileslist into large tar shards, set as `train_shards_dir` in the data config to
+stream them with `TarShardDataset` instead of opening millions of small files. Every clip is stored with its mel
+spectrogram, its whisper embeddings when `--audio_embeds_cache_dir` is given, and its metadata (path, frame count,
+fps, number of audio samples and content hash). A large fileslist can be split into parts packed by several processes
+into the same directory.
+"""
+
+import io
+import os
+import json
+import argparse
+from functools import partial
+from multiprocessing import Pool
+
+import torch
+import tqdm
+from decord import AudioReader
+
+from latentsync.data.dataset_index import probe_video
+from latentsync.data.tar_shard_dataset import TarShardWriter
+from latentsync.utils.audio import melspectrogram
+from latentsync.whisper.audio2feature import Audio2Feature
+
+
+def serialize_tensor(tensor: torch.Tensor) -> bytes:
+    buffer = io.BytesIO()
+    torch.save(tensor, buffer)
+    return buffer.getvalue()
+
+
+def read_clip(video_path: str, audio_mel_cache_dir: str = None, audio_sample_rate: int = 16000):
+    # The files of a clip except its whisper embeddings, None if the video is broken
+    probe = probe_video(video_path, audio_sample_rate)
+    if probe is None:
+        return video_path, None
+    num_frames, fps, num_audio_samples, content_hash = probe
+
+    try:
+        mel_cache_path = None
+        if audio_mel_cache_dir is not None:
+            mel_cache_path = os.path.join(audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt"))
+        if mel_cache_path is not None and os.path.isfile(mel_cache_path):
+            original_mel = torch.load(mel_cache_path, weights_only=True)
+        else:
+            # Same as `UNetDataset.read_audio`
+            ar = AudioReader(video_path, sample_rate=audio_sample_rate)
+            original_mel = torch.from_numpy(melspectrogram(ar[:].asnumpy().squeeze(0)))
+
+        with open(video_path, "rb") as f:
+            video_bytes = f.read()
+    except Exception as e:
+        print(f"{type(e).__name__} - {e} - {video_path}")
+        return video_path, None
+
+    metadata = dict(
+        video_path=video_path,
+        num_frames=num_frames,
+        fps=fps,
+        num_audio_samples=num_audio_samples,
+        audio_sample_rate=audio_sample_rate,
+        content_hash=content_hash,
+    )
+    files = {"mp4": video_bytes, "mel.pt": serialize_tensor(original_mel), "json": json.dumps(metadata).encode()}
+    return video_path, files
+
+
+def main(args):
+    with open(args.fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+    video_paths = video_paths[args.part_index :: args.num_parts]
+
+    audio_encoder = None
+    if args.audio_embeds_cache_dir is not None:
+        # Fills the embedding cache with the embeddings it misses
+        audio_encoder = Audio2Feature(
+            model_path=args.whisper_model_path, device=args.device, audio_embeds_cache_dir=args.audio_embeds_cache_dir
+        )
+
+    print(f"Packing {len(video_paths)} videos into {args.shards_dir}")
+    with TarShardWriter(
+        args.shards_dir, part_name=f"part{args.part_index}", shard_size_bytes=int(args.shard_size_gb * 1024**3)
+    ) as writer, Pool(args.num_workers) as pool:
+        # The order of the fileslist is kept, shuffle it beforehand to mix the sources in every shard
+        results = pool.imap(partial(read_clip, audio_mel_cache_dir=args.audio_mel_cache_dir), video_paths)
+        for video_path, files in tqdm.tqdm(results, total=len(video_paths)):
+            if files is None:
+                continue
+            if audio_encoder is not None:
+                try:
+                    with torch.no_grad():
+                        files["embeds.pt"] = serialize_tensor(audio_encoder.audio2feat(video_path).cpu())
+                except Exception as e:
+                    print(f"{type(e).__name__} - {e} - {video_path}")
+                    continue
+            writer.add(files)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fileslist", type=str, required=True)
+    parser.add_argument("--shards_dir", type=str, required=True)
+    parser.add_argument("--audio_mel_cache_dir", type=str, default=None, help="reuse the cached mel spectrograms")
+    parser.add_argument("--audio_embeds_cache_dir", type=str, default=None, help="also pack the whisper embeddings")
+    parser.add_argument("--whisper_model_path", type=str, default="checkpoints/whisper/tiny.pt")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_workers", type=int, default=16)
+    parser.add_argument("--num_parts", type=int, default=1)
+    parser.add_argument("--part_index", type=int, default=0)
+    parser.add_argument("--shard_size_gb", type=float, default=2)
+    args = parser.parse_args()
+
+    main(args)
@@ -49,8 +49,10 @@ def main(config, args):
     audio_encoder = Audio2Feature(
         model_path=whisper_model_path,
         device="cuda",
+        audio_embeds_cache_dir=args.audio_embeds_cache_dir,
         num_frames=config.data.num_frames,
         audio_feat_length=config.data.audio_feat_length,
+        audio_embeds_cache_size_bytes=int(args.audio_embeds_cache_size_gb * 1024**3),
     )
 
     vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=dtype)
@@ -72,6 +74,9 @@ def main(config, args):
         scheduler=scheduler,
     ).to("cuda")
 
+    if args.avatar_cache_dir is not None:
+        pipeline.enable_avatar_cache(args.avatar_cache_dir, int(args.avatar_cache_size_gb * 1024**3))
+
     if args.seed != -1:
         set_seed(args.seed)
     else:
@@ -92,6 +97,8 @@ def main(config, args):
         width=config.data.resolution,
         height=config.data.resolution,
         mask_image_path=mask_path_to_use,
+        streaming=args.streaming,
+        window_batch_size=args.window_batch_size,
     )
 
 
@@ -105,6 +112,12 @@ if __name__ == "__main__":
     parser.add_argument("--inference_steps", type=int, default=20)
     parser.add_argument("--guidance_scale", type=float, default=1.0)
     parser.add_argument("--seed", type=int, default=1247)
+    parser.add_argument("--streaming", action="store_true", help="process the video window by window to bound memory")
+    parser.add_argument("--avatar_cache_dir", type=str, default=None, help="reuse the preprocessing of seen videos")
+    parser.add_argument("--avatar_cache_size_gb", type=float, default=20)
+    parser.add_argument("--audio_embeds_cache_dir", type=str, default=None, help="reuse the embeddings of seen audio")
+    parser.add_argument("--audio_embeds_cache_size_gb", type=float, default=5)
+    parser.add_argument("--window_batch_size", type=int, default=1, help="number of windows denoised in one batch")
     args = parser.parse_args()
 
     config = OmegaConf.load(args.unet_config_path)
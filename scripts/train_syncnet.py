@@ -19,6 +19,7 @@ from omegaconf import OmegaConf
 import shutil
 
 from latentsync.data.syncnet_dataset import SyncNetDataset
+from latentsync.data.tar_shard_dataset import TarShardDataset
 from latentsync.models.stable_syncnet import StableSyncNet
 from latentsync.models.wav2lip_syncnet import Wav2LipSyncNet
 from latentsync.utils.util import gather_loss, plot_loss_chart
@@ -77,13 +78,26 @@ def main(config):
     train_dataset = SyncNetDataset(config.data.train_data_dir, config.data.train_fileslist, config)
     val_dataset = SyncNetDataset(config.data.val_data_dir, config.data.val_fileslist, config)
 
-    train_distributed_sampler = DistributedSampler(
-        train_dataset,
-        num_replicas=num_processes,
-        rank=global_rank,
-        shuffle=True,
-        seed=config.run.seed,
-    )
+    # Stream the clips packed by preprocess/pack_tar_shards.py, the shards are split between the ranks
+    train_shards_dir = getattr(config.data, "train_shards_dir", "")
+    if train_shards_dir != "":
+        train_dataset = TarShardDataset(
+            train_shards_dir,
+            train_dataset,
+            shuffle_buffer_size=getattr(config.data, "shuffle_buffer_size", 1000),
+            rank=global_rank,
+            world_size=num_processes,
+            seed=config.run.seed,
+        )
+        train_distributed_sampler = None
+    else:
+        train_distributed_sampler = DistributedSampler(
+            train_dataset,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=config.run.seed,
+        )
 
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
@@ -169,7 +183,10 @@ def main(config):
     scaler = torch.amp.GradScaler("cuda") if config.run.mixed_precision_training else None
 
     for epoch in range(first_epoch, num_train_epochs):
-        train_dataloader.sampler.set_epoch(epoch)
+        if train_distributed_sampler is None:
+            train_dataset.set_epoch(epoch)
+        else:
+            train_dataloader.sampler.set_epoch(epoch)
         syncnet.train()
         step_loss = 0
         optimizer.zero_grad()
@@ -34,9 +34,13 @@ import diffusers
 from diffusers import AutoencoderKL, DDIMScheduler
 from diffusers.utils.logging import get_logger
 from diffusers.optimization import get_scheduler
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from accelerate.utils import set_seed
 
 from latentsync.data.unet_dataset import UNetDataset
+from latentsync.data.unet_latent_dataset import UNetLatentDataset
+from latentsync.data.feature_store import FeatureStore
+from latentsync.data.tar_shard_dataset import TarShardDataset
 from latentsync.models.unet import UNet3DConditionModel
 from latentsync.models.stable_syncnet import StableSyncNet
 from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
@@ -46,7 +50,8 @@ from latentsync.utils.util import (
     one_step_sampling,
 )
 from latentsync.utils.util import plot_loss_chart
-from latentsync.whisper.audio2feature import Audio2Feature
+from latentsync.utils.image_processor import ImageProcessor, load_fixed_mask
+from latentsync.whisper.audio2feature import Audio2Feature, AudioEmbedsReader
 from latentsync.trepa.loss import TREPALoss
 from eval.syncnet import SyncNetEval
 from eval.syncnet_detect import SyncNetDetector
@@ -57,6 +62,12 @@ import lpips
 logger = get_logger(__name__)
 
 
+def sample_latents(latent_params: torch.Tensor, device) -> torch.Tensor:
+    # (b, f, 2 * c, h, w) precomputed distribution parameters -> ((b f), c, h, w) latents, like `vae.encode`
+    latent_params = rearrange(latent_params.to(device, dtype=torch.float16), "b f c h w -> (b f) c h w")
+    return DiagonalGaussianDistribution(latent_params).sample()
+
+
 def main(config):
     # Initialize distributed training
     local_rank = init_dist()
@@ -121,7 +132,11 @@ def main(config):
         audio_embeds_cache_dir=config.data.audio_embeds_cache_dir,
         num_frames=config.data.num_frames,
         audio_feat_length=config.data.audio_feat_length,
+        audio_embeds_cache_size_bytes=int(getattr(config.data, "audio_embeds_cache_size_gb", -1) * 1024**3),
     )
+    # Whisper embeddings packed by preprocess/build_feature_store.py, the embedding cache is the fallback
+    audio_embeds_store_dir = getattr(config.data, "audio_embeds_store_dir", "")
+    audio_embeds_store = FeatureStore(audio_embeds_store_dir) if audio_embeds_store_dir else None
 
     denoising_unet, resume_global_step = UNet3DConditionModel.from_pretrained(
         OmegaConf.to_container(config.model),
@@ -170,16 +185,60 @@ def main(config):
     if config.run.enable_gradient_checkpointing:
         denoising_unet.enable_gradient_checkpointing()
 
-    # Get the training dataset
-    train_dataset = UNetDataset(config.data.train_data_dir, config)
-    distributed_sampler = DistributedSampler(
-        train_dataset,
-        num_replicas=num_processes,
-        rank=global_rank,
-        shuffle=True,
-        seed=config.run.seed,
+    # The dataloader workers crop the audio windows of the embeddings already in the store or the cache
+    audio_embeds_reader = (
+        AudioEmbedsReader(audio_encoder, audio_embeds_store) if config.model.add_audio_layer else None
     )
 
+    # Get the training dataset, the latent dataset serves precomputed VAE latent distributions
+    use_latent_dataset = getattr(config.data, "latent_store_dir", "") != ""
+    if use_latent_dataset:
+        train_dataset = UNetLatentDataset(config.data.train_data_dir, config, audio_embeds_reader)
+    else:
+        train_dataset = UNetDataset(config.data.train_data_dir, config, audio_embeds_reader)
+
+    # Stream the clips packed by preprocess/pack_tar_shards.py, the shards are split between the ranks
+    train_shards_dir = getattr(config.data, "train_shards_dir", "")
+    if train_shards_dir != "":
+        if use_latent_dataset:
+            raise ValueError("The tar shards hold the videos, they cannot be used with latent_store_dir")
+        train_dataset = TarShardDataset(
+            train_shards_dir,
+            train_dataset,
+            shuffle_buffer_size=getattr(config.data, "shuffle_buffer_size", 1000),
+            rank=global_rank,
+            world_size=num_processes,
+            seed=config.run.seed,
+        )
+        distributed_sampler = None
+    else:
+        distributed_sampler = DistributedSampler(
+            train_dataset,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=config.run.seed,
+        )
+
+    if (
+        audio_embeds_reader is not None
+        and audio_embeds_store is None
+        and train_shards_dir == ""
+        and len(audio_embeds_reader.content_hashes) == 0
+    ):
+        # The workers look up the embedding cache by the content hashes of the dataset index
+        logger.warning(
+            "No dataset_index_path with content hashes, the audio embeddings are computed in the main process. "
+            "Build one with preprocess/build_dataset_index.py"
+        )
+
+    # Resizes, normalizes and masks the uint8 frames of the batch when the workers return them
+    gpu_image_processing = getattr(config.data, "gpu_image_processing", False)
+    if gpu_image_processing:
+        image_processor = ImageProcessor(
+            config.data.resolution, mask_image=load_fixed_mask(config.data.resolution, config.data.mask_image_path)
+        )
+
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
@@ -257,7 +316,10 @@ def main(config):
     scaler = torch.amp.GradScaler("cuda") if config.run.mixed_precision_training else None
 
     for epoch in range(first_epoch, num_train_epochs):
-        train_dataloader.sampler.set_epoch(epoch)
+        if distributed_sampler is None:
+            train_dataset.set_epoch(epoch)
+        else:
+            train_dataloader.sampler.set_epoch(epoch)
         denoising_unet.train()
 
         for step, batch in enumerate(train_dataloader):
@@ -267,39 +329,69 @@ def main(config):
                 if batch["mel"] != []:
                     mel = batch["mel"].to(device, dtype=torch.float16)
 
-                audio_embeds_list = []
+                # Only the windows missing from the embedding cache are computed here, the first time they are seen
+                audio_embeds = batch["audio_embeds"]
                 try:
                     for idx in range(len(batch["video_path"])):
+                        if batch["audio_embeds_available"][idx]:
+                            continue
                         video_path = batch["video_path"][idx]
                         start_idx = batch["start_idx"][idx]
 
                         with torch.no_grad():
                             audio_feat = audio_encoder.audio2feat(video_path)
-                        audio_embeds = audio_encoder.crop_overlap_audio_window(audio_feat, start_idx)
-                        audio_embeds_list.append(audio_embeds)
+                        audio_embeds[idx] = audio_encoder.crop_overlap_audio_window(audio_feat, start_idx).cpu()
                 except Exception as e:
                     logger.info(f"{type(e).__name__} - {e} - {video_path}")
                     continue
-                audio_embeds = torch.stack(audio_embeds_list)  # (B, 16, 50, 384)
-                audio_embeds = audio_embeds.to(device, dtype=torch.float16)
+                audio_embeds = audio_embeds.to(device, dtype=torch.float16)  # (B, 16, 50, 384)
             else:
                 audio_embeds = None
 
-            # Convert videos to latent space
-            gt_pixel_values = batch["gt_pixel_values"].to(device, dtype=torch.float16)
-            masked_pixel_values = batch["masked_pixel_values"].to(device, dtype=torch.float16)
-            masks = batch["masks"].to(device, dtype=torch.float16)
-            ref_pixel_values = batch["ref_pixel_values"].to(device, dtype=torch.float16)
+            if use_latent_dataset or not gpu_image_processing:
+                masks = batch["masks"].to(device, dtype=torch.float16)
+                masks = rearrange(masks, "b f c h w -> (b f) c h w")
+
+            if use_latent_dataset:
+                # The VAE encoder is not used, the gt pixels are only loaded for the pixel space losses
+                if config.run.pixel_space_supervise and gpu_image_processing:
+                    gt_frames = rearrange(batch["gt_pixel_values"].to(device), "b f c h w -> (b f) c h w")
+                    gt_pixel_values = image_processor.process_images_batch(gt_frames).to(dtype=torch.float16)
+                elif config.run.pixel_space_supervise:
+                    gt_pixel_values = batch["gt_pixel_values"].to(device, dtype=torch.float16)
+                    gt_pixel_values = rearrange(gt_pixel_values, "b f c h w -> (b f) c h w")
+
+                gt_latents = sample_latents(batch["gt_latent_params"], device)
+                masked_latents = sample_latents(batch["masked_latent_params"], device)
+                ref_latents = sample_latents(batch["ref_latent_params"], device)
+            else:
+                if gpu_image_processing:
+                    # One batched resize, normalize and mask of the uint8 frames of the whole batch
+                    gt_frames = rearrange(batch["gt_frames"].to(device), "b f c h w -> (b f) c h w")
+                    ref_frames = rearrange(batch["ref_frames"].to(device), "b f c h w -> (b f) c h w")
+                    gt_pixel_values, masked_pixel_values, masks = (
+                        image_processor.prepare_masks_and_masked_images_batch(gt_frames)
+                    )
+                    ref_pixel_values = image_processor.process_images_batch(ref_frames)
+
+                    gt_pixel_values = gt_pixel_values.to(dtype=torch.float16)
+                    masked_pixel_values = masked_pixel_values.to(dtype=torch.float16)
+                    ref_pixel_values = ref_pixel_values.to(dtype=torch.float16)
+                    masks = masks.to(dtype=torch.float16)
+                else:
+                    # Convert videos to latent space
+                    gt_pixel_values = batch["gt_pixel_values"].to(device, dtype=torch.float16)
+                    masked_pixel_values = batch["masked_pixel_values"].to(device, dtype=torch.float16)
+                    ref_pixel_values = batch["ref_pixel_values"].to(device, dtype=torch.float16)
 
-            gt_pixel_values = rearrange(gt_pixel_values, "b f c h w -> (b f) c h w")
-            masked_pixel_values = rearrange(masked_pixel_values, "b f c h w -> (b f) c h w")
-            masks = rearrange(masks, "b f c h w -> (b f) c h w")
-            ref_pixel_values = rearrange(ref_pixel_values, "b f c h w -> (b f) c h w")
+                    gt_pixel_values = rearrange(gt_pixel_values, "b f c h w -> (b f) c h w")
+                    masked_pixel_values = rearrange(masked_pixel_values, "b f c h w -> (b f) c h w")
+                    ref_pixel_values = rearrange(ref_pixel_values, "b f c h w -> (b f) c h w")
 
-            with torch.no_grad():
-                gt_latents = vae.encode(gt_pixel_values).latent_dist.sample()
-                masked_latents = vae.encode(masked_pixel_values).latent_dist.sample()
-                ref_latents = vae.encode(ref_pixel_values).latent_dist.sample()
+                with torch.no_grad():
+                    gt_latents = vae.encode(gt_pixel_values).latent_dist.sample()
+                    masked_latents = vae.encode(masked_pixel_values).latent_dist.sample()
+                    ref_latents = vae.encode(ref_pixel_values).latent_dist.sample()
 
             masks = torch.nn.functional.interpolate(masks, size=config.data.resolution // vae_scale_factor)
 
@@ -482,7 +574,7 @@ def main(config):
 
                 if config.model.add_audio_layer and os.path.exists(validation_video_out_path):
                     try:
-                        _, conf = syncnet_eval(syncnet_eval_model, syncnet_detector, validation_video_out_path, "temp")
+                        _, conf = syncnet_eval(syncnet_eval_model, syncnet_detector, validation_video_out_path)
                     except Exception as e:
                         logger.info(e)
                         conf = 0
@@ -0,0 +1,64 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+
+import numpy as np
+import torch
+from decord import AudioReader
+
+from latentsync.utils.audio import melspectrogram, melspectrogram_torch
+
+
+def check_parity(wavs, device, dtype, atol):
+    """
+    Compare the batched torch melspectrogram of waveforms of different lengths with the librosa one of every
+    waveform, return the maximum absolute difference
+    """
+    lengths = torch.tensor([len(wav) for wav in wavs])
+    batch = torch.zeros(len(wavs), int(lengths.max()), dtype=dtype)
+    for i, wav in enumerate(wavs):
+        batch[i, : len(wav)] = torch.from_numpy(wav)
+
+    mels = melspectrogram_torch(batch.to(device), lengths).cpu().double()
+
+    max_diff = 0.0
+    for i, wav in enumerate(wavs):
+        expected = torch.from_numpy(melspectrogram(wav)).double()
+        actual = mels[i, :, : expected.shape[1]]
+        max_diff = max(max_diff, (actual - expected).abs().max().item())
+    status = "OK" if max_diff <= atol else "FAILED"
+    print(f"{device} {dtype}: max abs diff {max_diff:.2e} (atol {atol:.0e}) {status}")
+    return max_diff <= atol
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio_paths", type=str, nargs="*", default=[], help="also compare on these files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    wavs = [(0.1 * rng.standard_normal(length)).astype(np.float32) for length in (16000, 23456, 40199)]
+    for audio_path in args.audio_paths:
+        wavs.append(AudioReader(audio_path, sample_rate=16000)[:].asnumpy().squeeze(0))
+
+    # The mel spectrogram ranges over [-4, 4], float32 differs by rounding only
+    devices = ["cpu", "cuda"] if torch.cuda.is_available() else ["cpu"]
+    passed = check_parity(wavs, "cpu", torch.float64, atol=1e-6)
+    for device in devices:
+        passed &= check_parity(wavs, device, torch.float32, atol=1e-3)
+
+    if not passed:
+        raise SystemExit(1)